@@ -0,0 +1,175 @@
+"""
+Benchmark of loading maflib embedded in maf.py.
+
+This script measures the time to import ``maf`` and ``maflib.core`` in fresh
+interpreters, which is paid by every waf invocation, in the following modes.
+
+- ``extract``: the former loader on a clean waf directory; the archive is
+  written to a temporary file and extracted before maflib is imported.
+- ``extracted``: the former loader when maflib is already extracted.
+- ``cold``: maflib is compiled from the archive in memory and cached.
+- ``warm``: maflib is loaded from the cache.
+- ``fresh``: a fresh checkout (a copy of maf.py and a clean waf directory)
+  loads maflib from a cache made by another checkout. It is the case of a new
+  checkout finding the per-user cache, or of CI jobs sharing the cache, and
+  should be compared with ``extract``.
+
+Modules of waflib are imported before the measurement, since their cost does
+not depend on the loader. Bytecode files are written as usual (maf.py of the
+fresh checkout is compiled before the measurement, as the former maf.py would
+be). The cache is put in the waf directory except for ``fresh``, so that the
+per-user cache is neither used nor touched.
+
+Run ``./waf configure`` first to unpack waflib, then run this script with the
+Python used by waf::
+
+    python benchmarks/startup.py
+
+"""
+
+import glob
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WAF_DIRS = glob.glob(os.path.join(ROOT, '.waf*-*'))
+
+PRELUDE = '''
+import sys
+sys.path[:0] = %(path)r
+import waflib.Build
+import waflib.Context
+import waflib.TaskGen
+import waflib.Utils
+waflib.Context.waf_dir = %(directory)r
+import time
+begin = time.time()
+'''
+
+EPILOGUE = '''
+import maflib.core
+sys.stdout.write('%%f' %% (time.time() - begin))
+'''
+
+LOADERS = {
+    # The former loader of maf.py.
+    'extract': '''
+import os
+import tarfile
+with open(os.path.join(%(root)r, 'maf.py'), 'rb') as f:
+    while f.readline() != '#==>\\n'.encode():
+        pass
+    content = f.readline()[1:-1].replace('#XXX'.encode(), '\\n'.encode())
+    content = content.replace('#YYY'.encode(), '\\r'.encode())
+archive = os.path.join(%(directory)r, 'maflib.tar.bz2')
+with open(archive, 'wb') as f:
+    f.write(content)
+t = tarfile.open(archive)
+t.extractall(%(directory)r)
+t.close()
+os.remove(archive)
+sys.path.insert(0, %(directory)r)
+''',
+    'extracted': '''
+sys.path.insert(0, %(directory)r)
+''',
+    'cold': '''
+sys.path.insert(0, %(root)r)
+import maf
+''',
+    'warm': '''
+sys.path.insert(0, %(root)r)
+import maf
+''',
+    'fresh': '''
+sys.path.insert(0, %(root)r)
+import maf
+''',
+}
+
+
+def measure(mode, directory, root=ROOT, cache=None):
+    """Runs a fresh interpreter that loads maflib in given mode and returns
+    the time to load it. maf.py is loaded from ``root``, and the cache is kept
+    in ``cache`` if given, or in the waf directory otherwise."""
+    variables = {
+        'path': WAF_DIRS[:1],
+        'root': root,
+        'directory': directory,
+    }
+    script = (PRELUDE + LOADERS[mode] + EPILOGUE) % variables
+    # Bytecode is written as usual, so that maf.py itself is not compiled on
+    # each run.
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['MAF_CACHE_DIR'] = directory if cache is None else cache
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    return float(output)
+
+
+def prepare(mode, directory):
+    """Makes the waf directory in the state expected by given mode."""
+    shutil.rmtree(directory, ignore_errors=True)
+    os.mkdir(directory)
+    if mode == 'fresh':
+        checkout, cache = fresh_paths(directory)
+        if not os.path.exists(cache):
+            # Another checkout made the cache.
+            measure('cold', directory, cache=cache)
+        shutil.rmtree(checkout, ignore_errors=True)
+        os.mkdir(checkout)
+        shutil.copy(os.path.join(ROOT, 'maf.py'), checkout)
+        # Importing maf.py once writes its bytecode (py_compile does not
+        # accept the archive). The waf directory is not touched, since the
+        # cache is in another directory.
+        measure(mode, directory, checkout, cache)
+    elif mode == 'extracted':
+        measure('extract', directory)
+        # Importing once more writes .pyc files.
+        measure('extracted', directory)
+    elif mode == 'warm':
+        measure('cold', directory)
+
+
+def fresh_paths(directory):
+    """Gets the paths to the fresh checkout and the shared cache."""
+    parent = os.path.dirname(directory)
+    return os.path.join(parent, 'checkout'), os.path.join(parent, 'cache')
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '--repeats', type='int', default=20,
+        help='number of measurements of each mode [default: %default]')
+    options, _ = parser.parse_args()
+
+    if not WAF_DIRS:
+        raise Exception('waflib is not found; run ./waf configure first')
+
+    directory = os.path.join(tempfile.mkdtemp(), 'waf')
+    try:
+        print('%10s %12s %12s' % ('mode', 'median', 'min'))
+        for mode in ['extract', 'extracted', 'cold', 'warm', 'fresh']:
+            times = []
+            for _ in range(options.repeats):
+                if mode in ('extract', 'cold', 'fresh') or not times:
+                    prepare(mode, directory)
+                if mode == 'fresh':
+                    checkout, cache = fresh_paths(directory)
+                    times.append(measure(mode, directory, checkout, cache))
+                else:
+                    times.append(measure(mode, directory))
+            times.sort()
+            print('%10s %10.1fms %10.1fms' %
+                  (mode, times[len(times) // 2] * 1000, times[0] * 1000))
+    finally:
+        shutil.rmtree(os.path.dirname(directory))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of task generation of waf experiment.
+
+This script measures the time to generate tasks of a small workflow for
+various grid sizes with :py:class:`maflib.core.ExperimentContext` and
+:py:class:`mafext.context.ExperimentContext`, and checks that both generate the
+same parameters. Only parameter handling and id generation are measured;
+creation of waf task generators, which is common to both, is skipped.
+
+Run ``./waf configure`` first to unpack waflib, then run this
+script with the Python used by waf::
+
+    python benchmarks/task_generation.py
+
+"""
+
+import collections
+import glob
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WAF_DIRS = glob.glob(os.path.join(ROOT, '.waf*-*'))
+sys.path[:0] = [ROOT] + WAF_DIRS
+
+import waflib.Context
+waflib.Context.waf_dir = WAF_DIRS[0]
+
+import maf
+import maflib.core
+import maflib.util
+import mafext.context
+
+
+def workflow(n):
+    """Call objects of a workflow whose largest meta node has about n
+    parameters."""
+    nx = int(n ** 0.5)
+    ny = n // nx
+    return [
+        dict(target='a', rule='true', parameters=maflib.util.product(
+            {'x': list(range(nx)), 'y': list(range(ny))})),
+        dict(target='b', rule='true', parameters=maflib.util.product(
+            {'x': list(range(nx))})),
+        dict(source='a b', target='c', rule='true', parameters=[{'r': 0}]),
+        dict(source='c', target='d', rule='true', aggregate_by='y'),
+    ]
+
+
+def generate(base, calls):
+    class Context(base):
+        # Skip creation of waf task generators and nodes.
+        def _call_super(self, call_object, source_parameter,
+                        target_parameter):
+            pass
+
+        def _resolve_meta_node(self, node, parameter):
+            if parameter:
+                self._parameter_id_generator.get_id(parameter)
+            return node
+
+    ctx = Context.__new__(Context)
+    ctx._nodes = collections.defaultdict(set)
+    table = os.path.join(tempfile.mkdtemp(), 'table')
+    ctx._parameter_id_generator = maflib.core.ParameterIdGenerator(
+        table, table + '.tsv')
+
+    call_objects = [maflib.core.CallObject(**kw) for kw in calls]
+    begin = time.time()
+    for call_object in call_objects:
+        ctx._process_call_object(call_object)
+    return time.time() - begin, ctx._nodes
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '--sizes', default='100,1000,10000,100000',
+        help='comma-separated grid sizes [default: %default]')
+    parser.add_option(
+        '--max-baseline-size', type='int', default=1000,
+        help='largest size run with maflib.core [default: %default]')
+    options, _ = parser.parse_args()
+
+    print('%10s %14s %14s %10s' % ('size', 'maflib.core', 'mafext', 'speedup'))
+    for n in [int(s) for s in options.sizes.split(',')]:
+        calls = workflow(n)
+        ext_time, ext_nodes = generate(
+            mafext.context.ExperimentContext, calls)
+        if n > options.max_baseline_size:
+            print('%10d %14s %13.3fs %10s' % (n, '-', ext_time, '-'))
+            continue
+
+        base_time, base_nodes = generate(
+            maflib.core.ExperimentContext, workflow(n))
+        if base_nodes != ext_nodes:
+            raise Exception('generated parameters differ at size %d' % n)
+        print('%10d %13.3fs %13.3fs %9.1fx' %
+              (n, base_time, ext_time, base_time / ext_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+"""
+Content-addressed cache of task results.
+
+Outputs of experiment tasks are stored in a cache directory under a key made
+of the signature of the task, which waf computes from the rule (including the
+sources of functions given by ``dependson``), the parameter and the signatures
+of the inputs, and of the sources of functions wrapped by the rule (see
+:py:func:`source_digest`). The key does not depend on paths, so a result
+computed in one build directory or checkout is reused by any task with the
+same rule, parameter and inputs. Since entries are written to temporary directories and
+renamed, a directory on a shared filesystem can be used by many machines at
+once as a stand-in for a remote cache.
+
+The layout of the cache is ``<path>/<first two digits of key>/<key>/<i>``,
+where ``<i>`` is the i-th output of the task. The modification time of an
+entry is updated each time it is used, and :py:meth:`ResultCache.evict`
+removes least recently used entries until the total size is within the limit.
+Since eviction walks the whole cache, it is run by
+:py:meth:`ResultCache.evict_if_due` only after new entries are stored, and at
+most once in :py:data:`EVICTION_INTERVAL` seconds by all processes sharing
+the cache; the time of the last eviction is kept in ``<path>/.last-eviction``.
+
+The cache is enabled by ``--result-cache`` option added by
+:py:mod:`mafext.context`.
+
+"""
+
+import functools
+import hashlib
+import inspect
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import types
+
+EVICTION_INTERVAL = 60 * 60
+"""Minimum interval of evictions in seconds."""
+
+_TEMPORARY_PREFIX = '.tmp-'
+_TEMPORARY_EXPIRATION = 24 * 60 * 60
+_EVICTION_STAMP = '.last-eviction'
+
+
+class ResultCache(object):
+    """Directory of task outputs keyed by task signatures.
+
+    All methods are safe to call from multiple threads and processes sharing
+    the directory. Failures of file operations make a lookup miss instead of
+    raising an exception, so a broken cache never breaks the experiment.
+
+    """
+    def __init__(self, path, max_size=None):
+        """Opens a cache directory, which is created if it does not exist.
+
+        :param path: Path to the cache directory.
+        :type path: ``str``
+        :param max_size: Maximum total size of entries in bytes, or None for no
+            limit.
+        :type max_size: ``int``
+
+        """
+        self.path = os.path.abspath(path)
+        """Path to the cache directory."""
+
+        self.max_size = max_size
+        """Maximum total size of entries in bytes."""
+
+        self.stored = 0
+        """Number of entries added by this object."""
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # Another process may have created it.
+                if not os.path.isdir(self.path):
+                    raise
+
+    def entry_path(self, key):
+        """Gets the path to the entry of given key."""
+        return os.path.join(self.path, key[:2], key)
+
+    def retrieve(self, key, paths):
+        """Copies files of an entry to given paths.
+
+        :param key: Key of the entry.
+        :type key: ``str``
+        :param paths: Paths to which the files of the entry are copied.
+        :type paths: ``list`` of ``str``
+        :return: True if the entry exists and has as many files as ``paths``
+            and all of them are copied.
+        :rtype: ``bool``
+
+        """
+        entry = self.entry_path(key)
+        if not os.path.exists(os.path.join(entry, str(len(paths) - 1))) or \
+                os.path.exists(os.path.join(entry, str(len(paths)))):
+            return False
+        try:
+            for i, path in enumerate(paths):
+                shutil.copyfile(os.path.join(entry, str(i)), path)
+            os.utime(entry, None)
+        except (IOError, OSError):
+            # The entry may have been evicted while copying.
+            return False
+        return True
+
+    def store(self, key, paths):
+        """Adds an entry of given files. An existing entry is left as it is.
+
+        :param key: Key of the entry.
+        :type key: ``str``
+        :param paths: Paths to files to be stored.
+        :type paths: ``list`` of ``str``
+        :return: True if the entry is added.
+        :rtype: ``bool``
+
+        """
+        entry = self.entry_path(key)
+        if os.path.exists(entry):
+            return False
+        try:
+            temporary = tempfile.mkdtemp(
+                prefix=_TEMPORARY_PREFIX, dir=self.path)
+        except OSError:
+            return False
+        try:
+            for i, path in enumerate(paths):
+                shutil.copyfile(path, os.path.join(temporary, str(i)))
+            if not os.path.isdir(os.path.dirname(entry)):
+                try:
+                    os.makedirs(os.path.dirname(entry))
+                except OSError:
+                    pass
+            os.rename(temporary, entry)
+        except (IOError, OSError):
+            # Another task may have stored the same entry.
+            shutil.rmtree(temporary, ignore_errors=True)
+            return False
+        self.stored += 1
+        return True
+
+    def entries(self):
+        """Lists entries of the cache.
+
+        :return: List of ``(path, size, mtime)`` of each entry, where ``size``
+            is the total size of files and ``mtime`` is the last time it was
+            stored or retrieved.
+        :rtype: ``list`` of ``tuple``
+
+        """
+        entries = []
+        for prefix in _listdir(self.path):
+            directory = os.path.join(self.path, prefix)
+            if prefix.startswith(_TEMPORARY_PREFIX) or \
+                    not os.path.isdir(directory):
+                continue
+            for key in _listdir(directory):
+                entry = os.path.join(directory, key)
+                try:
+                    mtime = os.stat(entry).st_mtime
+                    size = sum(os.path.getsize(os.path.join(entry, name))
+                               for name in os.listdir(entry))
+                except OSError:
+                    continue
+                entries.append((entry, size, mtime))
+        return entries
+
+    def evict(self):
+        """Removes least recently used entries until the total size of entries
+        gets within :py:attr:`max_size`. Temporary files left by interrupted
+        stores are also removed.
+
+        :return: Number of removed entries.
+        :rtype: ``int``
+
+        """
+        now = time.time()
+        for name in _listdir(self.path):
+            path = os.path.join(self.path, name)
+            try:
+                if name.startswith(_TEMPORARY_PREFIX) and \
+                        now - os.stat(path).st_mtime > _TEMPORARY_EXPIRATION:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+        if self.max_size is None:
+            return 0
+
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for entry, size, _ in sorted(entries, key=lambda e: e[2]):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def evict_if_due(self, interval=EVICTION_INTERVAL):
+        """Calls :py:meth:`evict` if entries have been added by this object and
+        no process has evicted the cache in last ``interval`` seconds. The
+        cache may exceed :py:attr:`max_size` until the next eviction.
+
+        :param interval: Minimum interval of evictions in seconds.
+        :type interval: ``float``
+        :return: Number of removed entries.
+        :rtype: ``int``
+
+        """
+        if not self.stored:
+            return 0
+        stamp = os.path.join(self.path, _EVICTION_STAMP)
+        try:
+            if time.time() - os.stat(stamp).st_mtime < interval:
+                return 0
+        except OSError:
+            pass
+        try:
+            with open(stamp, 'a'):
+                pass
+            os.utime(stamp, None)
+        except (IOError, OSError):
+            pass
+        return self.evict()
+
+
+def source_digest(fun):
+    """Computes a digest of the source code of a callable and the callables it
+    wraps.
+
+    The signature of a task only contains the source of the function given as
+    the rule, which is just a wrapper for rules made by decorators such as
+    :py:func:`maflib.util.json_aggregator`. This function follows
+    ``__wrapped__``, cells of closures, default arguments,
+    ``functools.partial`` and :py:class:`maflib.core.Rule`, and hashes the
+    sources of all functions and classes found, as well as values of basic
+    types.
+
+    :param fun: A callable.
+    :return: Hex digest, or None if the source of any callable is not
+        available, in which case the identity of the rule is unknown.
+    :rtype: ``str``
+
+    """
+    h = hashlib.md5()
+    # Visited objects are kept alive, so that their ids are not reused.
+    visited = {}
+    stack = [fun]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, _BASIC_TYPES):
+            h.update(repr(obj).encode('utf-8'))
+            continue
+        if id(obj) in visited:
+            continue
+        visited[id(obj)] = obj
+
+        if isinstance(obj, (list, tuple)):
+            stack += reversed(obj)
+        elif isinstance(obj, (set, frozenset)):
+            stack += sorted(obj, key=repr, reverse=True)
+        elif isinstance(obj, dict):
+            for key, value in sorted(
+                    obj.items(), key=lambda item: repr(item[0])):
+                stack += [value, key]
+        elif isinstance(obj, types.BuiltinFunctionType):
+            h.update(('%s.%s' % (obj.__module__, obj.__name__)).encode('utf-8'))
+        elif isinstance(obj, types.MethodType):
+            stack.append(obj.__func__)
+        elif isinstance(obj, functools.partial):
+            stack += [obj.keywords or {}, obj.args, obj.func]
+        elif isinstance(obj, (types.FunctionType, type)):
+            try:
+                source = inspect.getsource(obj)
+            except (IOError, TypeError):
+                return None
+            if not isinstance(source, bytes):
+                source = source.encode('utf-8')
+            h.update(source)
+            if isinstance(obj, types.FunctionType):
+                stack += _cell_contents(obj)
+                stack += list(obj.__defaults__ or ())
+                stack.append(getattr(obj, '__wrapped__', None))
+        elif hasattr(obj, 'fun') and hasattr(obj, 'dependson'):
+            # maflib.core.Rule
+            stack += [obj.dependson, obj.fun]
+        elif callable(obj):
+            stack.append(type(obj))
+    return h.hexdigest()
+
+
+try:
+    _BASIC_TYPES = (type(None), bool, int, long, float, str, unicode)
+except NameError:
+    _BASIC_TYPES = (type(None), bool, int, float, str, bytes)
+
+
+def _cell_contents(function):
+    contents = []
+    for cell in function.__closure__ or ():
+        try:
+            contents.append(cell.cell_contents)
+        except ValueError:
+            # The variable is not assigned yet.
+            pass
+    return contents
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
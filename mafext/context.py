@@ -0,0 +1,563 @@
+"""
+Extended context of waf experiment.
+
+Importing this module replaces the ``experiment`` command by
+:py:class:`ExperimentContext` defined here, which generates the same tasks as
+:py:class:`maflib.core.ExperimentContext` but scales to large parameter grids.
+
+Loaded as a waf tool, this module also adds ``--profile`` option to profile the
+command (see :py:mod:`mafext.profiling`) and ``--result-cache`` option to reuse
+results of tasks across build directories and checkouts (see
+:py:mod:`mafext.cache`).
+
+.. code-block:: py
+
+    def options(opt):
+        opt.load('maf')
+        opt.load('mafext.context')
+
+"""
+
+import collections
+import copy
+import os
+import time
+
+import waflib.Logs
+import waflib.Options
+import waflib.Task
+import waflib.Utils
+from waflib.TaskGen import before_method, feature
+
+import maflib.core
+import mafext.cache
+import mafext.idstore
+import mafext.profiling
+
+
+def options(opt):
+    opt.add_option(
+        '--profile', action='store_true', default=False,
+        help='record time of phases and tasks of experiment to %s and print '
+             'a summary' % mafext.profiling.TRACE_PATH)
+    opt.add_option(
+        '--result-cache', action='store',
+        default=os.environ.get('MAF_RESULT_CACHE'),
+        help='directory of the cache of task results shared by build '
+             'directories, possibly on a shared filesystem '
+             '(default: $MAF_RESULT_CACHE; disabled by --nocache)')
+    opt.add_option(
+        '--result-cache-size', action='store', type='int', default=10240,
+        help='maximum size of the result cache in megabytes; least recently '
+             'used results are removed [default: %default]')
+
+
+def configure(conf):
+    pass
+
+
+class ExperimentContext(maflib.core.ExperimentContext):
+    """Context class of waf experiment that scales to large parameter grids.
+
+    The base class spends most of the time of task generation on the
+    followings, which are replaced in this class.
+
+    - Source parameters are combined by filtering a cross product with pairwise
+      :py:meth:`maflib.core.Parameter.conflict_with`. Here they are joined on
+      their shared keys using hash indices (see :py:class:`ParameterIndex`).
+    - The whole call object, including the list of all parameters, is deep-
+      copied for each task. Here it is copied shallowly.
+    - Hash of :py:class:`maflib.core.Parameter` is computed on each lookup.
+      Here parameters are converted to :py:class:`FrozenParameter`, which
+      caches it.
+    - The table of parameter ids is loaded and saved as a whole. Here it is
+      stored in :py:class:`mafext.idstore.ParameterIdStore`.
+
+    With ``--profile``, phases of the command and tasks are recorded to
+    :py:attr:`profiler`.
+
+    """
+
+    def __init__(self, **kw):
+        super(ExperimentContext, self).__init__(**kw)
+
+        # Replace the callback registered by the base class.
+        self.pre_funs.remove(
+            maflib.core.ExperimentContext._process_call_objects)
+        self.add_pre_fun(ExperimentContext._process_call_objects)
+
+        self.profiler = None
+        """:py:class:`mafext.profiling.Profiler` if ``--profile`` is given."""
+        if getattr(waflib.Options.options, 'profile', False):
+            self.profiler = mafext.profiling.Profiler(self.jobs)
+
+        self.result_cache = None
+        """:py:class:`mafext.cache.ResultCache` if ``--result-cache`` is
+        given."""
+        path = getattr(waflib.Options.options, 'result_cache', None)
+        if path and not self.nocache:
+            self.result_cache = mafext.cache.ResultCache(
+                path, waflib.Options.options.result_cache_size * 1024 * 1024)
+
+        self.rule_digests = {}
+        """Mapping from ``id`` of rules to pairs of the rule and its
+        :py:func:`mafext.cache.source_digest`, shared by task generators."""
+
+        self._recursing = False
+
+    def execute(self):
+        if self.profiler is None:
+            return super(ExperimentContext, self).execute()
+        try:
+            with self.profiler.phase('experiment'):
+                super(ExperimentContext, self).execute()
+        finally:
+            self.profiler.write_trace(mafext.profiling.TRACE_PATH)
+            self.profiler.log_summary()
+            waflib.Logs.info(
+                'profile is written to %s' % mafext.profiling.TRACE_PATH)
+
+    def restore(self):
+        with mafext.profiling.phase(self.profiler, 'restore build state'):
+            super(ExperimentContext, self).restore()
+
+    def recurse(self, *k, **kw):
+        # wscripts may call recurse() recursively; only the outermost call is
+        # recorded.
+        if self._recursing:
+            return super(ExperimentContext, self).recurse(*k, **kw)
+        self._recursing = True
+        try:
+            with mafext.profiling.phase(self.profiler, 'read wscripts'):
+                super(ExperimentContext, self).recurse(*k, **kw)
+        finally:
+            self._recursing = False
+
+    def compile(self):
+        try:
+            with mafext.profiling.phase(self.profiler, 'run tasks'):
+                super(ExperimentContext, self).compile()
+        finally:
+            if self.result_cache is not None and self.result_cache.stored:
+                with mafext.profiling.phase(
+                        self.profiler, 'evict result cache'):
+                    self.result_cache.evict_if_due()
+
+    def store(self):
+        with mafext.profiling.phase(self.profiler, 'store build state'):
+            super(ExperimentContext, self).store()
+
+    def _process_call_objects(self):
+        """Callback function called right after all wscripts are executed.
+
+        This function virtually generates all task generators under
+        ExperimentContext.
+
+        """
+        with mafext.profiling.phase(self.profiler, 'process call objects'):
+            self._process_call_objects_profiled()
+
+    def _process_call_objects_profiled(self):
+        profiler = self.profiler
+
+        with mafext.profiling.phase(profiler, 'sort call objects'):
+            call_objects = self._experiment_graph.get_sorted_call_objects()
+
+        with mafext.profiling.phase(profiler, 'load parameter ids'):
+            self._parameter_id_generator = mafext.idstore.ParameterIdStore(
+                mafext.idstore.ID_TABLE_PATH,
+                mafext.idstore.LEGACY_ID_TABLE_PATH)
+        self._nodes = collections.defaultdict(set)
+
+        try:
+            for call_object in call_objects:
+                with mafext.profiling.phase(
+                        profiler, 'generate tasks of %s' %
+                        ' '.join(call_object.target)):
+                    self._process_call_object(call_object)
+        finally:
+            with mafext.profiling.phase(profiler, 'save parameter ids'):
+                self._parameter_id_generator.save()
+
+    def _generate_tasks(self, call_object):
+        parameters = [FrozenParameter(p) for p in call_object.parameters]
+
+        if not call_object.source:
+            for parameter in parameters:
+                self._generate_task(call_object, [], parameter)
+            return
+
+        # Pairs of a list of source parameters and their union.
+        combinations = [([], FrozenParameter())]
+        for node in call_object.source:
+            node_params = self._nodes[node]
+            if not node_params:
+                # node is physical. We use empty parameter as a dummy.
+                node_params = [FrozenParameter()]
+
+            index = ParameterIndex(node_params)
+            combinations = [
+                (source_parameter + [p], union.merge(p))
+                for source_parameter, union in combinations
+                for p in index.compatible_with(union)]
+
+        index = ParameterIndex(parameters)
+        for source_parameter, union in combinations:
+            for parameter in index.compatible_with(union):
+                self._generate_task(
+                    call_object, source_parameter, parameter,
+                    union.merge(parameter))
+
+    def _generate_task(self, call_object, source_parameter, parameter,
+                       target_parameter=None):
+        if target_parameter is None:
+            target_parameter = FrozenParameter()
+            for p in source_parameter + [parameter]:
+                target_parameter = target_parameter.merge(p)
+
+        for node in call_object.target:
+            self._nodes[node].add(target_parameter)
+
+        physical_call_object = copy.copy(call_object)
+        physical_call_object.source = self._resolve_meta_nodes(
+            call_object.source, source_parameter)
+        physical_call_object.target = self._resolve_meta_nodes(
+            call_object.target, target_parameter)
+        physical_call_object.features = list(call_object.features)
+        del physical_call_object.parameters
+
+        self._call_super(
+            physical_call_object, source_parameter, target_parameter)
+
+    def _generate_aggregation_tasks(self, call_object, key_type):
+        if not call_object.source or len(call_object.source) > 1:
+            raise maflib.core.InvalidMafArgumentException(
+                "'source' in aggregation must include only one meta node")
+        if not call_object.target or len(call_object.target) > 1:
+            raise maflib.core.InvalidMafArgumentException(
+                "'target' in aggregation must include only one meta node")
+
+        source_node = call_object.source[0]
+        target_node = call_object.target[0]
+
+        # Mapping from target parameter to list of source parameter.
+        target_to_source = collections.defaultdict(list)
+        if key_type == 'for_each':
+            keys = call_object.for_each
+            for source_parameter in self._nodes[source_node]:
+                target_parameter = FrozenParameter(
+                    (key, source_parameter[key]) for key in keys)
+                target_to_source[target_parameter].append(source_parameter)
+        else:
+            keys = set(call_object.aggregate_by)
+            for source_parameter in self._nodes[source_node]:
+                target_parameter = FrozenParameter(
+                    (key, value) for key, value in source_parameter.items()
+                    if key not in keys)
+                target_to_source[target_parameter].append(source_parameter)
+
+        for target_parameter, source_parameter in target_to_source.items():
+            self._nodes[target_node].add(target_parameter)
+
+            physical_call_object = copy.copy(call_object)
+            physical_call_object.source = [
+                self._resolve_meta_node(source_node, parameter)
+                for parameter in source_parameter]
+            physical_call_object.target = self._resolve_meta_node(
+                target_node, target_parameter)
+            physical_call_object.features = list(call_object.features)
+            delattr(physical_call_object, key_type)
+
+            self._call_super(
+                physical_call_object, source_parameter, target_parameter)
+
+
+class FrozenParameter(maflib.core.Parameter):
+    """Immutable parameter with a cached hash.
+
+    It is equal to, and has the same hash as, a
+    :py:class:`maflib.core.Parameter` with the same items, so both can be used
+    as keys of the same dictionary. Methods that modify the parameter raise
+    ``TypeError``; use :py:meth:`merge` to make a new one instead.
+
+    """
+    def __init__(self, *args, **kw):
+        super(FrozenParameter, self).__init__(*args, **kw)
+        self._hash = hash(frozenset(self.items()))
+
+    def __hash__(self):
+        return self._hash
+
+    def _immutable(self, *args, **kw):
+        raise TypeError('FrozenParameter is immutable')
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenParameter, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def merge(self, parameter):
+        """Makes a union of this and given parameter.
+
+        :param parameter: Parameter to be merged. Its values take precedence.
+        :type parameter: ``dict``
+        :rtype: :py:class:`FrozenParameter`
+
+        """
+        if not parameter:
+            return self
+        if not self:
+            return FrozenParameter(parameter)
+        d = dict(self)
+        d.update(parameter)
+        return FrozenParameter(d)
+
+
+class ParameterIndex(object):
+    """Index of parameters to find ones that do not conflict with a given
+    parameter.
+
+    Parameters are grouped by their key sets. For each group and each set of
+    keys shared with queried parameters, a hash index from the values of the
+    shared keys is built on demand, so a query costs one lookup per group
+    instead of a comparison with every parameter.
+
+    """
+    def __init__(self, parameters):
+        """Builds the index.
+
+        :param parameters: Parameters to be indexed.
+        :type parameters: iterable of :py:class:`maflib.core.Parameter`
+
+        """
+        self._groups = collections.defaultdict(list)
+        for parameter in parameters:
+            self._groups[frozenset(parameter)].append(parameter)
+        self._indices = {}
+
+    def compatible_with(self, parameter):
+        """Finds indexed parameters that do not conflict with given parameter.
+
+        :param parameter: Query parameter.
+        :type parameter: :py:class:`maflib.core.Parameter`
+        :return: Parameters that have the same values as ``parameter`` for all
+            their common keys, in the order of indexing within each group.
+        :rtype: ``list``
+
+        """
+        keys = frozenset(parameter)
+        result = []
+        for key_set, group in self._groups.items():
+            shared = tuple(sorted(key_set & keys))
+            if not shared:
+                result += group
+                continue
+
+            index = self._indices.get((key_set, shared))
+            if index is None:
+                index = collections.defaultdict(list)
+                for p in group:
+                    index[tuple(p[k] for k in shared)].append(p)
+                self._indices[(key_set, shared)] = index
+
+            result += index.get(tuple(parameter[k] for k in shared), [])
+        return result
+
+
+class ExperimentTask(maflib.core.ExperimentTask):
+    """Task class of experiment that can be profiled and cached.
+
+    If the build context has a :py:class:`mafext.profiling.Profiler` as
+    ``profiler`` attribute, the task records to it the time it became ready to
+    run, the times it started and finished running, and the sizes of its
+    inputs before and outputs after running (see :py:func:`record_tasks`).
+
+    If the build context has a :py:class:`mafext.cache.ResultCache` as
+    ``result_cache`` attribute, outputs are retrieved from the cache instead of
+    running the rule if the cache has a result of the same key, and stored to
+    the cache after the rule runs (see :py:func:`cache_results`). Tasks whose
+    rule has no available source are not cached.
+
+    """
+    def runnable_status(self):
+        status = super(ExperimentTask, self).runnable_status()
+        if status == waflib.Task.RUN_ME and self._profiler() is not None:
+            self.ready_time = time.time()
+        return status
+
+    def process(self):
+        if self._profiler() is not None:
+            self.input_size = mafext.profiling.total_size(self.inputs)
+            self.begin_time = time.time()
+        super(ExperimentTask, self).process()
+
+    def record_profile(self):
+        """Records the task to the profiler when it finishes running."""
+        profiler = self._profiler()
+        if profiler is None or not hasattr(self, 'begin_time'):
+            return
+        end = time.time()
+        bld = self.generator.bld
+        name = ' '.join(node.path_from(bld.bldnode) for node in self.outputs)
+        profiler.add_task(
+            self, name or self.__class__.__name__,
+            getattr(self, 'ready_time', self.begin_time), self.begin_time, end,
+            self.input_size, mafext.profiling.total_size(self.outputs))
+
+    def retrieve_results(self):
+        """Copies the outputs from the result cache.
+
+        :return: True if the outputs are retrieved.
+        :rtype: ``bool``
+
+        """
+        key = self.result_key()
+        if not self.outputs or key is None:
+            return False
+        bld = self.generator.bld
+        paths = [node.abspath() for node in self.outputs]
+        if not bld.result_cache.retrieve(key, paths):
+            return False
+        if bld.progress_bar < 1:
+            for path in paths:
+                bld.to_log('restoring from result cache %r\n' % path)
+        self.result_cached = True
+        return True
+
+    def store_results(self):
+        """Copies the outputs to the result cache unless they are retrieved
+        from it."""
+        key = self.result_key()
+        if getattr(self, 'result_cached', False) or not self.outputs or \
+                key is None:
+            return
+        self.generator.bld.result_cache.store(
+            key, [node.abspath() for node in self.outputs])
+
+    def result_key(self):
+        """Gets the key of the outputs in the result cache, which is the hex
+        digest of the task signature and the sources of the functions wrapped
+        by the rule (see :py:func:`mafext.cache.source_digest`).
+
+        :return: The key, or None if the source of the rule is not available.
+        :rtype: ``str``
+
+        """
+        # A task class is made for each task generator, but generators of a
+        # parameter grid share the rule, so the digest is kept by the rule. The
+        # rule is kept with the digest so that its id is not reused.
+        rule = self.generator.rule
+        digests = self.generator.bld.rule_digests
+        if id(rule) not in digests:
+            if isinstance(rule, str):
+                digest = ''
+            else:
+                digest = mafext.cache.source_digest(rule)
+            digests[id(rule)] = rule, digest
+        digest = digests[id(rule)][1]
+        if digest is None:
+            return None
+        return waflib.Utils.to_hex(self.signature()) + digest
+
+    def _profiler(self):
+        return getattr(self.generator.bld, 'profiler', None)
+
+    def _result_cache(self):
+        return getattr(self.generator.bld, 'result_cache', None)
+
+
+def cache_results(cls):
+    """Wraps ``run`` and ``post_run`` of a task class to use the result cache,
+    as :py:func:`waflib.Task.cache_outputs` does for ``WAFCACHE``.
+
+    The class must be derived from :py:class:`ExperimentTask`. Wrapping does
+    not change ``hcode`` of the class, so signatures of tasks do not change.
+
+    :param cls: Task class.
+    :return: The class.
+
+    """
+    run = cls.run
+    def cached_run(self):
+        if self._result_cache() is not None and self.retrieve_results():
+            return 0
+        return run(self)
+    cls.run = cached_run
+
+    post_run = cls.post_run
+    def cached_post_run(self):
+        ret = post_run(self)
+        if self._result_cache() is not None:
+            self.store_results()
+        return ret
+    cls.post_run = cached_post_run
+
+    return cls
+
+
+def record_tasks(cls):
+    """Wraps ``run`` and ``post_run`` of a task class to record tasks to the
+    profiler by :py:meth:`ExperimentTask.record_profile`.
+
+    A task is recorded when ``run`` fails or ``post_run`` returns, since waf
+    hands the task back to the main thread right after that, which may then
+    write the trace before another worker gets a chance to record it.
+
+    :param cls: Task class derived from :py:class:`ExperimentTask`.
+    :return: The class.
+
+    """
+    run = cls.run
+    def recorded_run(self):
+        try:
+            ret = run(self)
+        except Exception:
+            self.record_profile()
+            raise
+        if ret:
+            self.record_profile()
+        return ret
+    cls.run = recorded_run
+
+    post_run = cls.post_run
+    def recorded_post_run(self):
+        try:
+            return post_run(self)
+        finally:
+            self.record_profile()
+    cls.post_run = recorded_post_run
+
+    return cls
+
+
+@feature('experiment')
+@before_method('process_rule')
+def register_experiment_task_with_rule(self):
+    """Replacement of :py:func:`maflib.core.register_experiment_task_with_rule`
+    that derives task classes from :py:class:`ExperimentTask` of this module.
+
+    The task classes have the same names and the same rules as those of
+    :py:mod:`maflib.core`, so signatures of tasks do not change. They are
+    wrapped by :py:func:`cache_results` and :py:func:`record_tasks`.
+
+    """
+    self.name = str(getattr(self, 'name', None) or self.target or
+                    getattr(self.rule, '__name__', self.rule))
+    params = {}
+    if isinstance(self.rule, str):
+        params['run_str'] = self.rule
+    else:
+        params['run'] = self.rule
+
+    cls = type(waflib.Task.Task)(self.name, (ExperimentTask,), params)
+    record_tasks(cache_results(cls))
+    waflib.Task.classes[self.name] = cls
+
+    self.bld.cache_rule_attr = {(self.name, self.rule): cls}
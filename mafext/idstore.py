@@ -0,0 +1,185 @@
+"""
+Persistent store of parameter ids.
+
+:py:class:`ParameterIdStore` is a replacement of
+:py:class:`maflib.core.ParameterIdGenerator` backed by SQLite. The generator
+loads the whole table at startup and rewrites it on every save; the store looks
+up each parameter through an index and saves only ids generated since the last
+save. The human-readable table is written only on demand by ``waf dump_ids``.
+
+"""
+
+import os
+import os.path
+import sqlite3
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import waflib.Context
+import waflib.Logs
+
+import maflib.core
+
+
+ID_TABLE_PATH = 'build/experiment/.maf_id_table.db'
+"""Path to the database of parameter ids."""
+
+LEGACY_ID_TABLE_PATH = 'build/experiment/.maf_id_table'
+"""Path to the table of :py:class:`maflib.core.ParameterIdGenerator`, which is
+imported to an empty database."""
+
+TEXT_ID_TABLE_PATH = 'build/experiment/.maf_id_table.tsv'
+"""Path to the human-readable table written by ``waf dump_ids``."""
+
+
+class ParameterIdStore(object):
+    """Consistent generator of physical node identifiers backed by SQLite.
+
+    Each row of the database has an id, a canonical string of the parameter
+    (indexed) and the pickled parameter. The canonical string is the ``repr``
+    of sorted items of the parameter.
+
+    The interface is the same as :py:class:`maflib.core.ParameterIdGenerator`,
+    so it can be used in place of the generator. Like the generator,
+    :py:meth:`save` must be called even when an exception is raised during
+    task generation.
+
+    """
+    def __init__(self, path, legacy_path=None):
+        """Opens the store.
+
+        :param path: Path to the database file. It is created if it does not
+            exist.
+        :type path: str
+        :param legacy_path: Path to the table saved by
+            :py:class:`maflib.core.ParameterIdGenerator`. If the database is
+            empty and the table exists, ids in the table are imported.
+        :type legacy_path: str
+
+        """
+        self.path = path
+        """Path to the database file."""
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS parameter_ids ('
+            'id INTEGER PRIMARY KEY, '
+            'key TEXT NOT NULL UNIQUE, '
+            'parameter BLOB NOT NULL)')
+
+        self._cache = {}
+        self._new = []
+        self._next_id = self._max_id() + 1
+
+        if self._next_id == 0 and legacy_path and os.path.exists(legacy_path):
+            self._import(legacy_path)
+            self._next_id = self._max_id() + 1
+
+    def get_id(self, parameter):
+        """Gets the id of given parameter.
+
+        :param parameter: Parameter object.
+        :type parameter: :py:class:`maflib.core.Parameter`
+        :return: Identifier of given parameter. The id may be generated in this
+            method if necessary.
+        :rtype: str
+
+        """
+        try:
+            return self._cache[parameter]
+        except KeyError:
+            pass
+
+        key = _canonical_key(parameter)
+        row = self._db.execute(
+            'SELECT id FROM parameter_ids WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            parameter_id = str(row[0])
+        else:
+            parameter_id = str(self._next_id)
+            self._new.append((self._next_id, key, _pickle(parameter)))
+            self._next_id += 1
+
+        self._cache[parameter] = parameter_id
+        return parameter_id
+
+    def save(self):
+        """Writes ids generated since the last save to the database."""
+        if not self._new:
+            return
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO parameter_ids (id, key, parameter) '
+                'VALUES (?, ?, ?)', self._new)
+        self._new = []
+
+    def dump(self, text_path):
+        """Dumps the table to a human-readable file.
+
+        Each line of the file is an id and the parameter separated by a tab, as
+        the file written by :py:class:`maflib.core.ParameterIdGenerator`.
+
+        :param text_path: Path to the output file.
+        :type text_path: str
+
+        """
+        with open(text_path, 'w') as f:
+            rows = self._db.execute(
+                'SELECT id, parameter FROM parameter_ids ORDER BY id')
+            for parameter_id, blob in rows:
+                parameter = maflib.core.Parameter(pickle.loads(bytes(blob)))
+                f.write('%s\t%s\n' % (parameter_id, parameter))
+
+    def close(self):
+        """Closes the database. Unsaved ids are discarded."""
+        self._db.close()
+
+    def _max_id(self):
+        row = self._db.execute('SELECT MAX(id) FROM parameter_ids').fetchone()
+        if row[0] is None:
+            return -1
+        return row[0]
+
+    def _import(self, legacy_path):
+        # See ParameterIdGenerator.save() for the format.
+        with open(legacy_path, 'rb') as f:
+            try:
+                dict_param_list = pickle.load(f)
+            except EOFError:
+                return
+        rows = [(i, _canonical_key(p), _pickle(p))
+                for i, p in enumerate(dict_param_list) if p is not None]
+        with self._db:
+            self._db.executemany(
+                'INSERT INTO parameter_ids (id, key, parameter) '
+                'VALUES (?, ?, ?)', rows)
+
+
+class DumpIdsContext(waflib.Context.Context):
+    """Writes the human-readable table of parameter ids."""
+
+    cmd = 'dump_ids'
+
+    def execute(self):
+        if not os.path.exists(ID_TABLE_PATH):
+            waflib.Logs.warn('%s does not exist' % ID_TABLE_PATH)
+            return
+        store = ParameterIdStore(ID_TABLE_PATH)
+        try:
+            store.dump(TEXT_ID_TABLE_PATH)
+        finally:
+            store.close()
+        waflib.Logs.info('parameter ids are written to %s' % TEXT_ID_TABLE_PATH)
+
+
+def _canonical_key(parameter):
+    return repr(sorted(parameter.items()))
+
+
+def _pickle(parameter):
+    return sqlite3.Binary(pickle.dumps(dict(parameter), 2))
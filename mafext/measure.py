@@ -0,0 +1,515 @@
+"""
+Rules to measure the computing time of commands.
+
+Commands measured by the rules of this module run on CPUs reserved for them:
+each measured task takes the requested number of CPUs from a pool shared by all
+tasks of the experiment, pins its child process to them, and gives them back
+after the child exits. Once the pool is made, waf itself is pinned to the CPUs
+outside the pool, if any. Tasks that cannot get enough CPUs wait for other
+measurements to finish, so ``waf experiment -j N`` does not let simultaneous
+measurements disturb each other.
+
+Times and resource usages are taken from ``os.wait4`` of the command instead of
+parsing the output of ``time`` command. The command is forked by a small
+launcher process rather than by waf, so they do not include the waf process.
+
+:py:func:`measured` runs a command once per task; repeats are expressed by a
+parameter such as ``ExecutionCount``. :py:func:`adaptive` instead repeats a
+command within one task until the confidence interval of its computing time is
+narrow enough, so quiet commands stop early.
+
+The CPU pool is configured by the options added by this module; load it as a
+waf tool to enable them.
+
+.. code-block:: py
+
+    def options(opt):
+        opt.load('maf')
+        opt.load('mafext.measure')
+
+"""
+
+import json
+import math
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+
+import waflib.Errors
+import waflib.Options
+import waflib.Utils
+
+import maflib.core
+import mafext.util
+
+
+def options(opt):
+    opt.add_option(
+        '--measure-cpus', action='store', default=None,
+        help='CPUs used for measured commands, e.g. "0-3,8" '
+             '(default: all CPUs available to waf)')
+    opt.add_option(
+        '--reserve-cpus', action='store', type='int', default=1,
+        help='number of CPUs excluded from the measurement pool for waf and '
+             'the system (ignored with --measure-cpus); waf is pinned to '
+             'the CPUs outside the pool [default: %default]')
+
+
+def configure(conf):
+    pass
+
+
+def measured(cmd, cpus=1, check=True):
+    """Creates a rule that runs a shell command and measures its computing
+    time.
+
+    ``cmd`` is a shell command in which ``${KEY}`` is replaced with the
+    parameter value of ``KEY``, and ``${SRC}`` and ``${TGT}`` are replaced with
+    the paths to input and output nodes, respectively. As in rule strings of
+    waf, ``${NAME}`` of other names and other ``$`` are passed to the shell as
+    they are. The command runs on ``cpus`` CPUs reserved for it.
+
+    The rule writes a JSON object like below to the first output node.
+
+    .. code-block:: javascript
+
+        {"real": 1.002, "user": 0.001, "sys": 0.0, "maxrss": 1824,
+         "returncode": 0}
+
+    ``real`` is the wall-clock time, ``user`` and ``sys`` are the CPU times in
+    seconds, and ``maxrss`` is the maximum resident set size of the command in
+    kilobytes. Messages printed by the command are not written to the output
+    node, so the record can be used as it is by succeeding tasks.
+
+    :param cmd: Shell command to be measured.
+    :type cmd: ``str``
+    :param cpus: Number of CPUs reserved for the command.
+    :type cpus: ``int``
+    :param check: If True, the task fails when the command exits with a
+        non-zero status. The measurement is written in either case.
+    :type check: ``bool``
+    :return: A rule.
+    :rtype: :py:class:`maflib.core.Rule`
+
+    """
+    def body(task):
+        record = run(_substitute(cmd, task), cpus)
+        task.outputs[0].write(json.dumps(record))
+        if check:
+            return record['returncode']
+        return 0
+
+    return maflib.core.Rule(fun=body, dependson=[measured, cmd, cpus, check])
+
+
+def adaptive(cmd, max_relative_ci=0.05, max_absolute_ci=None, min_repeats=3,
+             max_repeats=30, key='real', cpus=1, check=True):
+    """Creates a rule that repeats measurement of a shell command until the
+    confidence interval of its computing time is narrow enough.
+
+    The command is measured in the same way as :py:func:`measured` at least
+    ``min_repeats`` times. Then it is repeated until the half width of the 95%
+    confidence interval of the mean of ``key`` gets at most ``max_relative_ci``
+    times the mean (or at most ``max_absolute_ci`` seconds, if given), or the
+    number of repeats reaches ``max_repeats``.
+
+    Finished repeats are logged to a file next to the output node, whose name
+    contains the parameter id given by
+    :py:class:`maflib.core.ParameterIdGenerator`. When the task runs again for
+    the same parameter, command, ``cpus`` and inputs, e.g. after
+    ``max_repeats`` is increased, the logged repeats are reused and only
+    additional repeats are run; if ``max_repeats`` is decreased, only the first
+    ``max_repeats`` of them are written. The log is discarded if any of them
+    changes.
+
+    The rule writes a JSON array of the records of all repeats to the output
+    node. Each record is the one written by :py:func:`measured` with an
+    additional ``repeat`` key, so the array can be aggregated by
+    :py:func:`maflib.util.aggregator` as it is.
+
+    :param cmd: Shell command to be measured. See :py:func:`measured`.
+    :type cmd: ``str``
+    :param max_relative_ci: Target half width of the confidence interval
+        relative to the mean.
+    :type max_relative_ci: ``float``
+    :param max_absolute_ci: Target half width of the confidence interval in
+        seconds. It is useful for commands too short to get a relatively
+        narrow interval.
+    :type max_absolute_ci: ``float`` or None
+    :param min_repeats: Minimum number of repeats. It must be at least 2.
+    :type min_repeats: ``int``
+    :param max_repeats: Maximum number of repeats.
+    :type max_repeats: ``int``
+    :param key: Key of the record used for the confidence interval.
+    :type key: ``str``
+    :param cpus: Number of CPUs reserved for the command.
+    :type cpus: ``int``
+    :param check: If True, the task fails when the command exits with a
+        non-zero status. Failed repeats are not logged.
+    :type check: ``bool``
+    :return: A rule.
+    :rtype: :py:class:`maflib.core.Rule`
+
+    """
+    if min_repeats < 2 or max_repeats < min_repeats:
+        raise maflib.core.InvalidMafArgumentException(
+            'adaptive requires 2 <= min_repeats <= max_repeats')
+
+    def converged(records):
+        n = len(records)
+        if n < min_repeats:
+            return False
+        if n >= max_repeats:
+            return True
+        mean, half_width = _confidence_interval([r[key] for r in records])
+        if max_absolute_ci is not None and half_width <= max_absolute_ci:
+            return True
+        return half_width <= max_relative_ci * abs(mean)
+
+    def body(task):
+        command = _substitute(cmd, task)
+        log = _RepeatLog(
+            task.outputs[0].abspath() + '.repeats',
+            {'command': command, 'cpus': cpus, 'inputs': _signatures(task)})
+        # The log may have more repeats if max_repeats has been decreased.
+        records = log.load()[:max_repeats]
+        returncode = 0
+
+        while not converged(records):
+            record = run(command, cpus)
+            record['repeat'] = len(records)
+            records.append(record)
+            if check and record['returncode'] != 0:
+                returncode = record['returncode']
+                break
+            log.append(record)
+
+        task.outputs[0].write(json.dumps(records))
+        return returncode
+
+    return maflib.core.Rule(
+        fun=body,
+        dependson=[adaptive, cmd, max_relative_ci, max_absolute_ci,
+                   min_repeats, max_repeats, key, cpus, check])
+
+
+def run(cmd, cpus=1):
+    """Runs a shell command on reserved CPUs and measures it.
+
+    :param cmd: Shell command to be run.
+    :type cmd: ``str``
+    :param cpus: Number of CPUs reserved for the command.
+    :type cpus: ``int``
+    :return: A dictionary with ``real``, ``user``, ``sys``, ``maxrss`` and
+        ``returncode`` keys. See :py:func:`measured` for detail.
+    :rtype: ``dict``
+
+    """
+    pool = get_cpu_pool()
+    reserved = pool.acquire(cpus)
+    try:
+        return _run_on(cmd, reserved)
+    finally:
+        pool.release(reserved)
+
+
+class CpuPool(object):
+    """Pool of CPUs shared by measured tasks.
+
+    Tasks of waf run on threads of one process, so the pool is protected by a
+    condition variable. :py:meth:`acquire` blocks until enough CPUs are free.
+
+    """
+    def __init__(self, cpus):
+        """Initializes the pool.
+
+        :param cpus: CPU numbers managed by the pool.
+        :type cpus: ``list`` of ``int``
+
+        """
+        if not cpus:
+            raise waflib.Errors.WafError('no CPU is available for measurement')
+        self.cpus = sorted(cpus)
+        """All CPU numbers managed by the pool."""
+
+        self._free = list(self.cpus)
+        self._condition = threading.Condition()
+
+    def acquire(self, n):
+        """Takes ``n`` CPUs from the pool, waiting for them if necessary.
+
+        :param n: Number of CPUs to take.
+        :type n: ``int``
+        :return: Taken CPU numbers.
+        :rtype: ``list`` of ``int``
+
+        """
+        if n > len(self.cpus):
+            raise waflib.Errors.WafError(
+                '%d CPUs are requested, but the measurement pool has only %d' %
+                (n, len(self.cpus)))
+        with self._condition:
+            while len(self._free) < n:
+                self._condition.wait()
+            taken = self._free[:n]
+            del self._free[:n]
+            return taken
+
+    def release(self, cpus):
+        """Gives CPUs taken by :py:meth:`acquire` back to the pool.
+
+        :param cpus: CPU numbers to be released.
+        :type cpus: ``list`` of ``int``
+
+        """
+        with self._condition:
+            self._free.extend(cpus)
+            self._free.sort()
+            self._condition.notify_all()
+
+
+_cpu_pool = None
+_cpu_pool_lock = threading.Lock()
+
+
+def get_cpu_pool():
+    """Gets the CPU pool of this process, creating it from options on the
+    first call.
+
+    :rtype: :py:class:`CpuPool`
+
+    """
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = CpuPool(_configured_cpus())
+            _pin_self(sorted(set(_available_cpus()) - set(_cpu_pool.cpus)))
+        return _cpu_pool
+
+
+def parse_cpu_list(s):
+    """Parses CPU list string in the format of ``taskset -c``.
+
+    .. code-block:: py
+
+        parse_cpu_list('0-3,8')  # => [0, 1, 2, 3, 8]
+
+    :param s: Comma-separated CPU numbers or ranges.
+    :type s: ``str``
+    :rtype: ``list`` of ``int``
+
+    """
+    cpus = set()
+    for item in s.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '-' in item:
+            begin, end = item.split('-', 1)
+            cpus.update(range(int(begin), int(end) + 1))
+        else:
+            cpus.add(int(item))
+    return sorted(cpus)
+
+
+def _configured_cpus():
+    options = waflib.Options.options
+    cpu_list = getattr(options, 'measure_cpus', None)
+    if cpu_list:
+        return parse_cpu_list(cpu_list)
+
+    available = _available_cpus()
+    reserved = getattr(options, 'reserve_cpus', 1)
+    if reserved >= len(available):
+        # Nothing is left on a small machine; share the CPUs with waf.
+        return available
+    return available[reserved:]
+
+
+def _available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def _pin_self(cpus):
+    # Confines all threads of waf to CPUs outside the measurement pool. Nothing
+    # is done if the pool takes all CPUs.
+    if not cpus:
+        return
+    if not hasattr(os, 'sched_setaffinity'):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(
+                ['taskset', '-a', '-p', '-c', ','.join(str(c) for c in cpus),
+                 str(os.getpid())], stdout=devnull, stderr=devnull)
+        return
+    try:
+        threads = [int(tid) for tid in os.listdir('/proc/self/task')]
+    except OSError:
+        threads = [0]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            # The thread may have exited.
+            pass
+
+
+def _run_on(cmd, cpus):
+    # The command is started by a small launcher, so that the clock and the
+    # resource usage cover the command only, not the waf process forked for
+    # it. The launcher writes the record to a temporary file, since the output
+    # of the command goes to stdout.
+    cpu_list = ','.join(str(c) for c in cpus)
+    fd, path = tempfile.mkstemp(prefix='maf-measure-')
+    os.close(fd)
+    try:
+        args = [sys.executable, '-S', '-c', _LAUNCHER, cpu_list, cmd, path]
+        if not hasattr(os, 'sched_setaffinity'):
+            # Python 2 does not have sched_setaffinity; let taskset pin the
+            # launcher, and the command with it.
+            args = ['taskset', '-c', cpu_list] + args
+        returncode = subprocess.call(args)
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            raise waflib.Errors.WafError(
+                'failed to launch measured command %r (exit status %d)' %
+                (cmd, returncode))
+    finally:
+        os.remove(path)
+
+
+_LAUNCHER = '''
+import json, os, sys, time
+cpus, cmd, path = sys.argv[1:]
+if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, [int(c) for c in cpus.split(',')])
+clock = getattr(time, 'monotonic', time.time)
+begin = clock()
+pid = os.fork()
+if pid == 0:
+    try:
+        os.execv('/bin/sh', ['/bin/sh', '-c', cmd])
+    finally:
+        os._exit(127)
+_, status, usage = os.wait4(pid, 0)
+end = clock()
+if os.WIFSIGNALED(status):
+    returncode = -os.WTERMSIG(status)
+else:
+    returncode = os.WEXITSTATUS(status)
+with open(path, 'w') as f:
+    json.dump({'real': end - begin, 'user': usage.ru_utime,
+               'sys': usage.ru_stime, 'maxrss': usage.ru_maxrss,
+               'returncode': returncode}, f)
+'''
+
+
+# Two-sided 95% critical values of Student's t distribution indexed by degrees
+# of freedom. Values for larger degrees of freedom are looked up by the nearest
+# smaller entry.
+_T_95 = [
+    (1, 12.706), (2, 4.303), (3, 3.182), (4, 2.776), (5, 2.571), (6, 2.447),
+    (7, 2.365), (8, 2.306), (9, 2.262), (10, 2.228), (11, 2.201),
+    (12, 2.179), (13, 2.160), (14, 2.145), (15, 2.131), (16, 2.120),
+    (17, 2.110), (18, 2.101), (19, 2.093), (20, 2.086), (21, 2.080),
+    (22, 2.074), (23, 2.069), (24, 2.064), (25, 2.060), (26, 2.056),
+    (27, 2.052), (28, 2.048), (29, 2.045), (30, 2.042), (40, 2.021),
+    (60, 2.000), (120, 1.980),
+]
+
+
+def _confidence_interval(values):
+    n = len(values)
+    mean = float(sum(values)) / n
+    variance = sum((v - mean) ** 2 for v in values) / (n - 1)
+    t = [t for df, t in _T_95 if df <= n - 1][-1]
+    return mean, t * math.sqrt(variance / n)
+
+
+class _RepeatLog(object):
+    # Log of finished repeats of a command; the first line is a header that
+    # identifies the measurement (the command, the number of CPUs and the
+    # signatures of inputs) and each following line is a JSON record of one
+    # repeat.
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+
+    def load(self):
+        records = []
+        try:
+            with open(self.path) as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return records
+
+        try:
+            if json.loads(lines[0]) == self.header:
+                for line in lines[1:-1]:
+                    records.append(json.loads(line))
+                if lines[-1] == '':
+                    return records
+        except ValueError:
+            # The last line may be broken by an interruption.
+            pass
+
+        # The log is broken or made by another measurement; keep valid
+        # records.
+        os.remove(self.path)
+        for record in records:
+            self.append(record)
+        return records
+
+    def append(self, record):
+        if not os.path.exists(self.path):
+            with open(self.path, 'w') as f:
+                f.write(json.dumps(self.header) + '\n')
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def _signatures(task):
+    # Hexadecimal signatures of input nodes. Node lists of
+    # maflib.test.TestTask grow on access, so the underlying list is used.
+    signatures = []
+    for node in getattr(task.inputs, 'list', task.inputs):
+        signatures.append(
+            waflib.Utils.to_hex(mafext.util.node_signature(node)))
+    return signatures
+
+
+_VARIABLE = re.compile(r'\$\{(\w+)\}')
+
+
+def _substitute(cmd, task):
+    variables = _CommandVariables(task)
+    def replace(match):
+        try:
+            return variables[match.group(1)]
+        except KeyError:
+            # Left to the shell, e.g. ${HOME}.
+            return match.group(0)
+    return _VARIABLE.sub(replace, cmd)
+
+
+class _CommandVariables(dict):
+    # SRC and TGT are resolved only when used, since node lists of
+    # maflib.test.TestTask grow on access.
+    def __init__(self, task):
+        super(_CommandVariables, self).__init__(
+            (k, str(v)) for k, v in task.parameter.items())
+        self._task = task
+
+    def __missing__(self, key):
+        if key == 'SRC':
+            return ' '.join(node.abspath() for node in self._task.inputs)
+        if key == 'TGT':
+            return ' '.join(node.abspath() for node in self._task.outputs)
+        raise KeyError(key)
@@ -0,0 +1,304 @@
+"""
+Profiling of waf experiment.
+
+With ``waf experiment --profile``, :py:class:`mafext.context.ExperimentContext`
+records the phases of the command (restoring the build state, reading
+wscripts, generating tasks, loading and saving parameter ids, running tasks and
+storing the build state) and, for each task that runs, the time it waited in
+the queue after it became ready, the time it ran and the sizes of its inputs
+and outputs.
+
+The records are written to :py:data:`TRACE_PATH` in the Chrome trace event
+format, which can be opened with Perfetto (https://ui.perfetto.dev) or
+``chrome://tracing``. Each worker thread of waf is a track of the trace, and a
+counter track shows the numbers of running and queued tasks. A summary table is
+printed at the end of the command: time of each phase, total and mean times of
+tasks, the parallelism achieved, time of idle workers, and the critical path
+through the dependencies of tasks.
+
+The options are added by :py:mod:`mafext.context`; load it as a waf tool to
+enable them.
+
+.. code-block:: py
+
+    def options(opt):
+        opt.load('maf')
+        opt.load('mafext.context')
+
+"""
+
+import collections
+import contextlib
+import json
+import os
+import os.path
+import threading
+import time
+
+import waflib.Logs
+
+
+TRACE_PATH = 'build/experiment/.maf_profile.json'
+"""Path to the trace written by ``waf experiment --profile``."""
+
+TaskRecord = collections.namedtuple(
+    'TaskRecord',
+    'task name thread ready begin end input_size output_size')
+"""Record of a task. Times are given by ``time.time()``; ``ready`` is the time
+the task became ready to run, and ``begin`` and ``end`` are the times it
+started and finished running. ``input_size`` and ``output_size`` are the total
+sizes of the input files before and the output files after running, not the
+I/O performed by the task (which may also read and write other files)."""
+
+PhaseRecord = collections.namedtuple('PhaseRecord', 'name begin end depth')
+"""Record of a phase of the command. ``depth`` is the number of phases that
+enclose it."""
+
+
+class Profiler(object):
+    """Collector of phases and tasks of a waf command.
+
+    Phases are recorded by the main thread; tasks may be recorded by any
+    thread.
+
+    """
+    def __init__(self, jobs=1):
+        """Starts profiling.
+
+        :param jobs: Number of tasks run in parallel, i.e. ``-j`` of waf.
+        :type jobs: ``int``
+
+        """
+        self.jobs = jobs
+        self.begin = time.time()
+        self.phases = []
+        self.tasks = []
+
+        self._depth = 0
+        self._threads = {threading.current_thread().ident: 0}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Records the time spent in a ``with`` block as a phase."""
+        begin = time.time()
+        depth = self._depth
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth = depth
+            self.phases.append(PhaseRecord(name, begin, time.time(), depth))
+
+    def add_task(self, task, name, ready, begin, end, input_size,
+                 output_size):
+        """Records a task run by the current thread."""
+        ident = threading.current_thread().ident
+        with self._lock:
+            thread = self._threads.setdefault(ident, len(self._threads))
+            self.tasks.append(TaskRecord(
+                task, name, thread, ready, begin, end, input_size,
+                output_size))
+
+    def write_trace(self, path):
+        """Writes the records in the Chrome trace event format.
+
+        :param path: Path to the output file.
+        :type path: ``str``
+
+        """
+        pid = os.getpid()
+        events = [
+            _metadata('process_name', pid, 0, 'waf experiment'),
+            _metadata('thread_name', pid, 0, 'main'),
+        ]
+        for thread in sorted(set(self._threads.values()) - set([0])):
+            events.append(
+                _metadata('thread_name', pid, thread, 'worker %d' % thread))
+
+        for phase in self.phases:
+            events.append({
+                'name': phase.name, 'cat': 'phase', 'ph': 'X', 'pid': pid,
+                'tid': 0, 'ts': self._us(phase.begin),
+                'dur': _us(phase.end - phase.begin)})
+
+        for task in self.tasks:
+            events.append({
+                'name': task.name, 'cat': 'task', 'ph': 'X', 'pid': pid,
+                'tid': task.thread, 'ts': self._us(task.begin),
+                'dur': _us(task.end - task.begin),
+                'args': {
+                    'queue_wait_ms': (task.begin - task.ready) * 1000,
+                    'input_size_bytes': task.input_size,
+                    'output_size_bytes': task.output_size,
+                }})
+
+        for t, queued, running in self._timeline():
+            events.append({
+                'name': 'tasks', 'ph': 'C', 'pid': pid, 'tid': 0,
+                'ts': self._us(t),
+                'args': {'running': running, 'queued': queued}})
+
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self, slowest=5):
+        """Makes a summary table of the records.
+
+        :param slowest: Number of the slowest tasks listed in the table.
+        :type slowest: ``int``
+        :return: Lines of the table.
+        :rtype: ``list`` of ``str``
+
+        """
+        # Phases of the same name and depth are summed up, in the order they
+        # started.
+        totals = collections.OrderedDict()
+        for phase in sorted(self.phases, key=lambda p: p.begin):
+            key = (phase.depth, '  ' * phase.depth + phase.name)
+            totals[key] = totals.get(key, 0.0) + phase.end - phase.begin
+
+        tasks = self.tasks
+        slowest_tasks = sorted(tasks, key=lambda t: t.begin - t.end)[:slowest]
+        width = max([40] + [len(name) for _, name in totals] +
+                    [len(t.name) for t in slowest_tasks])
+        row = '%%-%ds' % width
+
+        lines = [(row + ' %12s') % ('phase', 'time')]
+        for (_, name), total in totals.items():
+            lines.append((row + ' %11.3fs') % (name, total))
+
+        if not tasks:
+            lines.append('no task ran')
+            return lines
+
+        run = sum(t.end - t.begin for t in tasks)
+        waits = [t.begin - t.ready for t in tasks]
+        wall = max(t.end for t in tasks) - min(t.ready for t in tasks)
+        parallelism = run / wall if wall else 0.0
+        idle, starved = self._idle_time()
+        length, chain = self._critical_path()
+
+        count, seconds = row + ' %12d', row + ' %11.3fs'
+        lines += [
+            '',
+            count % ('tasks run', len(tasks)),
+            seconds % ('run time (total)', run),
+            seconds % ('run time (mean)', run / len(tasks)),
+            seconds % ('queue wait (mean)', sum(waits) / len(tasks)),
+            seconds % ('queue wait (max)', max(waits)),
+            count % ('input size (bytes)', sum(t.input_size for t in tasks)),
+            count % ('output size (bytes)',
+                     sum(t.output_size for t in tasks)),
+            seconds % ('wall time of tasks', wall),
+            (row + ' %12.2f') % (
+                'parallelism (jobs: %d)' % self.jobs, parallelism),
+            seconds % ('idle worker time', idle),
+            seconds % ('idle worker time with queued tasks', starved),
+            seconds % ('critical path (%d tasks)' % len(chain), length),
+        ]
+
+        lines += ['', (row + ' %12s %12s %12s %12s') % (
+            'slowest tasks', 'wait', 'run', 'input size', 'output size')]
+        for t in slowest_tasks:
+            lines.append((row + ' %11.3fs %11.3fs %12d %12d') % (
+                t.name, t.begin - t.ready, t.end - t.begin, t.input_size,
+                t.output_size))
+        return lines
+
+    def log_summary(self):
+        """Prints the summary table by ``waflib.Logs.info``."""
+        for line in self.summary():
+            waflib.Logs.info(line)
+
+    def _us(self, t):
+        return _us(t - self.begin)
+
+    def _timeline(self):
+        # Numbers of queued and running tasks at each time they change.
+        changes = []
+        for task in self.tasks:
+            changes += [(task.ready, 1, 0), (task.begin, -1, 1),
+                        (task.end, 0, -1)]
+        changes.sort()
+
+        timeline = []
+        queued = running = 0
+        for t, dq, dr in changes:
+            queued += dq
+            running += dr
+            if timeline and timeline[-1][0] == t:
+                timeline.pop()
+            timeline.append((t, queued, running))
+        return timeline
+
+    def _idle_time(self):
+        # Total time of idle workers between the first and last tasks, and that
+        # while some tasks were waiting in the queue.
+        idle = starved = 0.0
+        timeline = self._timeline()
+        for (t, queued, running), (next_t, _, _) in zip(
+                timeline, timeline[1:]):
+            free = max(self.jobs - running, 0)
+            idle += free * (next_t - t)
+            starved += min(free, queued) * (next_t - t)
+        return idle, starved
+
+    def _critical_path(self):
+        # Longest chain of run times through dependencies between tasks. A task
+        # starts after all tasks it depends on finish, so they are visited
+        # before it.
+        paths = {}
+        for record in sorted(self.tasks, key=lambda t: t.begin):
+            length, chain = 0.0, []
+            for dependency in getattr(record.task, 'run_after', ()):
+                path = paths.get(id(dependency))
+                if path is not None and path[0] > length:
+                    length, chain = path
+            paths[id(record.task)] = (
+                length + record.end - record.begin, chain + [record])
+        if not paths:
+            return 0.0, []
+        return max(paths.values(), key=lambda p: p[0])
+
+
+def phase(profiler, name):
+    """Records a phase to given profiler, or does nothing if it is None.
+
+    .. code-block:: py
+
+        with mafext.profiling.phase(self.profiler, 'generate tasks'):
+            ...
+
+    """
+    if profiler is None:
+        return _nothing()
+    return profiler.phase(name)
+
+
+def total_size(nodes):
+    """Sums up the sizes of files of given nodes. Missing files are ignored."""
+    size = 0
+    for node in nodes:
+        try:
+            size += os.path.getsize(node.abspath())
+        except OSError:
+            pass
+    return size
+
+
+@contextlib.contextmanager
+def _nothing():
+    yield
+
+
+def _metadata(name, pid, tid, value):
+    return {'name': name, 'ph': 'M', 'pid': pid, 'tid': tid,
+            'args': {'name': value}}
+
+
+def _us(seconds):
+    return int(round(seconds * 1e6))
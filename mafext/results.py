@@ -0,0 +1,589 @@
+"""
+Columnar store of experiment results.
+
+Results written to the physical nodes of a meta node can also be appended to
+one file per meta node by wrapping the rule with :py:func:`sink`. The file is a
+NumPy ``.npy`` file of a structured array: each field is a typed column of a
+parameter key or a result key, and the file can be memory-mapped by
+``numpy.load(path, mmap_mode='r')``. It is placed next to the directory of the
+meta node, e.g. ``build/experiment/computing_time.columns.npy``.
+
+Aggregators created by :py:func:`column_aggregator` and :py:func:`plot_by`
+read the store of their source meta node instead of each input file, and
+:py:class:`ColumnPlotData` groups, sorts and filters the columns by NumPy
+operations.
+
+Each append is a batch of rows of one parameter id. When a task runs again,
+rows of its previous batch are superseded by the new batch; they remain in the
+file until :py:meth:`ColumnStore.compact` is called, which
+:py:meth:`ColumnStore.columns` does once superseded rows outnumber the latest
+ones.
+
+Rows are stamped with the signature of the task that made them. An output may
+change without its rule running, e.g. when it is restored from the result cache
+of :py:mod:`mafext.cache`, so aggregators read an input from its file again if
+the stamp of its rows differs from the signature of the input node.
+
+"""
+
+import functools
+import json
+import numbers
+import os
+import os.path
+import struct
+import threading
+
+import numpy as np
+import waflib.Utils
+
+import maflib.core
+import maflib.plot
+import mafext.util
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+ID_COLUMN = '_id'
+"""Column of parameter ids."""
+
+BATCH_COLUMN = '_batch'
+"""Column of batch numbers, which tell the rows of the latest append of each
+parameter id."""
+
+SIGNATURE_COLUMN = '_signature'
+"""Column of stamps of the signatures of the nodes from which rows are made.
+A stamp is the first 52 bits of the signature, which are exact even in a float
+column."""
+
+_STRING_WIDTH = 64
+_MAGIC = b'\x93NUMPY\x01\x00'
+
+
+def sink(rule):
+    """Wraps a rule to append its result to the columnar store of the target
+    meta node.
+
+    After ``rule`` runs, the JSON object or array of objects written to the
+    first output node is appended to the store together with the parameter of
+    the task. Values that are not numbers or strings are not stored.
+
+    :param rule: A rule whose output is JSON, e.g. a rule of
+        :py:mod:`mafext.measure`.
+    :type rule: :py:class:`maflib.core.Rule` or ``function``
+    :return: A rule.
+    :rtype: :py:class:`maflib.core.Rule`
+
+    """
+    if isinstance(rule, _string_types):
+        raise maflib.core.InvalidMafArgumentException(
+            'sink cannot wrap a rule string')
+    if not isinstance(rule, maflib.core.Rule):
+        rule = maflib.core.Rule(rule, [])
+
+    def body(task):
+        ret = rule.fun(task)
+        if ret:
+            return ret
+        output = task.outputs[0]
+        content = json.loads(output.read())
+        signature = None
+        if hasattr(task, 'signature'):
+            # Outputs get the signature of the task after it runs.
+            signature = signature_stamp(task.signature())
+        ColumnStore(store_path(output.abspath())).append(
+            parameter_id(output.abspath()),
+            _to_rows(content, task.parameter), signature)
+        return ret
+
+    return maflib.core.Rule(fun=body, dependson=[sink] + rule.dependson)
+
+
+def column_aggregator(callback_body):
+    """Creates an aggregator that reads inputs from the columnar store.
+
+    This is a counterpart of :py:func:`maflib.util.aggregator`. Instead of a
+    list of dictionaries, ``callback_body`` receives a dictionary from column
+    names to NumPy arrays, which contains the rows of all inputs of the task.
+    Inputs not found in the store, e.g. results made before :py:func:`sink`
+    was used, and inputs whose rows are stamped with another signature, e.g.
+    results restored from the result cache, are read from their files and
+    added to the store.
+
+    :param callback_body: A function or a callable object that takes three
+        arguments: ``columns``, ``abspath`` and ``parameter``. See
+        :py:func:`maflib.util.aggregator` for the others. This function should
+        return str or None.
+    :type callback_body: ``function`` or callable object of signature
+        ``(dict, str, dict)``.
+    :return: An aggregator function that calls ``callback_body``.
+    :rtype: ``function``
+
+    """
+    @functools.wraps(callback_body)
+    def callback(task):
+        inputs = list(zip(task.inputs, task.env.source_parameter))
+        if not inputs:
+            columns = {}
+        else:
+            store = ColumnStore(store_path(inputs[0][0].abspath()))
+            columns = store.columns([parameter_id(node.abspath())
+                                     for node, _ in inputs])
+            stamps = _stamps(columns)
+            missing = []
+            for node, parameter in inputs:
+                # Rows of nodes not made by waf are not checked.
+                signature = mafext.util.node_signature(node, hash_file=False)
+                if signature is not None:
+                    signature = signature_stamp(signature)
+                i = parameter_id(node.abspath())
+                if i not in stamps or \
+                        signature is not None and stamps[i] != signature:
+                    missing.append((node, parameter, signature))
+            for node, parameter, signature in missing:
+                store.append(parameter_id(node.abspath()),
+                             _to_rows(json.loads(node.read()), parameter),
+                             signature)
+            if missing:
+                columns = store.columns([parameter_id(node.abspath())
+                                         for node, _ in inputs])
+
+        abspath = task.outputs[0].abspath()
+        result = callback_body(columns, abspath, task.parameter)
+
+        if result is not None:
+            task.outputs[0].write(result)
+
+    return callback
+
+
+def plot_by(callback_body):
+    """Creates an aggregator to plot data of the columnar store.
+
+    This is a counterpart of :py:func:`maflib.plot.plot_by`; the second
+    argument of ``callback_body`` is a :py:class:`ColumnPlotData`.
+
+    :param callback_body: Callable object or function that plots data. It takes
+        a :py:class:`matplotlib.figure.Figure`, a :py:class:`ColumnPlotData`
+        and a parameter.
+    :type callback_body: ``function`` or callable object
+
+    """
+    @functools.wraps(callback_body)
+    @column_aggregator
+    def callback(columns, abspath, parameter):
+        figure = maflib.plot.matplotlib.pyplot.figure()
+        callback_body(figure, ColumnPlotData(columns), parameter)
+        figure.savefig(abspath)
+        return None
+
+    return callback
+
+
+def store_path(node_path):
+    """Gets the path to the store of the meta node of a physical node.
+
+    :param node_path: Path to a physical node of a meta node.
+    :type node_path: ``str``
+    :rtype: ``str``
+
+    """
+    return os.path.dirname(node_path) + '.columns.npy'
+
+
+def signature_stamp(signature):
+    """Gets the stamp of a signature stored in :py:data:`SIGNATURE_COLUMN`.
+
+    :param signature: Signature of a task or a node given by waf.
+    :type signature: ``bytes``
+    :rtype: ``int``
+
+    """
+    return int(waflib.Utils.to_hex(signature)[:13], 16)
+
+
+def parameter_id(node_path):
+    """Gets the parameter id of a physical node from its path.
+
+    :param node_path: Path to a physical node named ``<id>-<meta node>``.
+    :type node_path: ``str``
+    :rtype: ``int``
+
+    """
+    try:
+        return int(os.path.basename(node_path).split('-', 1)[0])
+    except ValueError:
+        raise maflib.core.InvalidMafArgumentException(
+            '%s is not a node of a parameterized meta node' % node_path)
+
+
+class ColumnStore(object):
+    """Columnar store of results of one meta node.
+
+    The store is a ``.npy`` file whose header is padded so that it can be
+    rewritten in place when rows are appended. A new column, or a value that
+    does not fit the type of its column, rewrites the whole file with wider
+    types: bool < int < float < string. Appends in a process are serialized by
+    a lock per file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        """Path to the store file."""
+
+    def append(self, parameter_id, rows, signature=None):
+        """Appends a batch of rows of a parameter id.
+
+        :param parameter_id: Parameter id of the rows. Rows of the previous
+            batch of the same id are superseded.
+        :type parameter_id: ``int``
+        :param rows: Rows to be appended. Keys beginning with ``_`` are
+            reserved.
+        :type rows: ``list`` of ``dict``
+        :param signature: Stamp of the signature of the node the rows are made
+            from (see :py:func:`signature_stamp`), or None if unknown.
+        :type signature: ``int``
+
+        """
+        reserved = {ID_COLUMN: parameter_id}
+        if signature is not None:
+            reserved[SIGNATURE_COLUMN] = signature
+        with _lock(self.path):
+            header = _read_header(self.path)
+            count = header[1] if header else 0
+            reserved[BATCH_COLUMN] = count
+            rows = [dict(row, **reserved) for row in rows]
+            if not rows:
+                return
+
+            old_dtype = header[0] if header else None
+            dtype = _merge_dtype(old_dtype, rows)
+            if dtype != old_dtype:
+                if header:
+                    data = _convert(self.load(), dtype)
+                else:
+                    data = np.zeros(0, dtype)
+                _write(self.path, np.concatenate([data, _to_array(rows, dtype)]))
+                return
+
+            array = _to_array(rows, dtype)
+            offset = header[2]
+            with open(self.path, 'r+b') as f:
+                f.seek(offset + count * dtype.itemsize)
+                f.write(array.tobytes())
+                f.truncate()
+                f.seek(0)
+                f.write(_header_bytes(dtype, count + len(array), offset))
+
+    def load(self):
+        """Loads all rows including superseded ones as a memory-mapped array.
+
+        :rtype: ``numpy.ndarray`` of a structured type, or None if the store
+            does not exist.
+
+        """
+        if not os.path.exists(self.path):
+            return None
+        return np.load(self.path, mmap_mode='r')
+
+    def columns(self, ids=None):
+        """Gets columns of the latest rows.
+
+        :param ids: Parameter ids of rows to be returned. All rows are returned
+            if None.
+        :type ids: ``list`` of ``int`` or None
+        :return: Dictionary from column names to arrays. It is empty if the
+            store does not exist.
+        :rtype: ``dict``
+
+        The store is compacted if more than half of its rows are superseded.
+
+        """
+        data = self.load()
+        if data is None:
+            return {}
+        mask = _latest(data[ID_COLUMN], data[BATCH_COLUMN])
+        superseded = len(mask) > 2 * np.count_nonzero(mask)
+        if ids is not None:
+            mask &= np.in1d(data[ID_COLUMN], np.asarray(ids, dtype=np.int64))
+        columns = {}
+        for name in data.dtype.names:
+            columns[name] = np.asarray(data[name][mask])
+        del data
+        if superseded:
+            self.compact()
+        return columns
+
+    def compact(self):
+        """Removes superseded rows from the file."""
+        with _lock(self.path):
+            data = self.load()
+            if data is None:
+                return
+            latest = np.array(data[_latest(data[ID_COLUMN], data[BATCH_COLUMN])])
+            del data
+            # Batch numbers of later appends start from the number of rows,
+            # so kept rows, one batch per id, are renumbered below it.
+            latest[BATCH_COLUMN] = 0
+            _write(self.path, latest)
+
+
+class ColumnPlotData(maflib.plot.PlotData):
+    """:py:class:`maflib.plot.PlotData` on columns of the columnar store.
+
+    The interface is the same as that of :py:class:`maflib.plot.PlotData`.
+    A value is missing if its column does not exist, it is NaN in a float
+    column, or it is an empty string in a string column.
+
+    """
+    def __init__(self, columns):
+        """Constructs a plot data from columns.
+
+        :param columns: Dictionary from column names to arrays of the same
+            length, e.g. the first argument of the callback body passed to
+            :py:func:`column_aggregator`.
+        :type columns: ``dict``
+
+        """
+        self._columns = columns
+
+    def get_data_1d(self, x, key=None, sort=True):
+        return self._get_data([x], key, sort)
+
+    def get_data_2d(self, x, y, key=None, sort=True):
+        return self._get_data([x, y], key, sort)
+
+    def get_data_3d(self, x, y, z, key=None, sort=True):
+        return self._get_data([x, y, z], key, sort)
+
+    get_data_1d.__doc__ = maflib.plot.PlotData.get_data_1d.__doc__
+    get_data_2d.__doc__ = maflib.plot.PlotData.get_data_2d.__doc__
+    get_data_3d.__doc__ = maflib.plot.PlotData.get_data_3d.__doc__
+
+    def _get_data(self, names, key, sort):
+        if key is None:
+            keys = []
+        elif isinstance(key, _string_types):
+            keys = [key]
+        else:
+            keys = list(key)
+
+        def result(values):
+            if len(names) == 1:
+                return values[0].tolist()
+            return tuple(v.tolist() for v in values)
+
+        if any(name not in self._columns for name in names + keys):
+            if key is None:
+                return result([np.array([])] * len(names))
+            return {}
+
+        mask = None
+        for name in names + keys:
+            present = _present(self._columns[name])
+            mask = present if mask is None else mask & present
+        values = [self._columns[name][mask] for name in names]
+
+        if key is None:
+            if sort:
+                order = np.lexsort(values[::-1])
+                values = [v[order] for v in values]
+            return result(values)
+
+        key_values = [self._columns[k][mask] for k in keys]
+        first, inverse = _group(key_values)
+        if sort:
+            order = np.lexsort(values[::-1] + [inverse])
+        else:
+            order = np.argsort(inverse, kind='mergesort')
+        values = [v[order] for v in values]
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(first)))[:-1]
+        groups = zip(*[np.split(v, bounds) for v in values])
+
+        data = {}
+        for i, group in zip(first, groups):
+            k = tuple(v[i].item() for v in key_values)
+            if isinstance(key, _string_types):
+                k = k[0]
+            data[k] = result(group)
+        return data
+
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(path):
+    path = os.path.abspath(path)
+    with _locks_lock:
+        if path not in _locks:
+            _locks[path] = threading.Lock()
+        return _locks[path]
+
+
+def _stamps(columns):
+    # Gets a dictionary from parameter ids to the stamps of their latest rows.
+    # Rows without stamps have NaN, which is not equal to any stamp.
+    ids = columns.get(ID_COLUMN, np.array([])).tolist()
+    if SIGNATURE_COLUMN not in columns:
+        return dict((i, None) for i in ids)
+    return dict(zip(ids, columns[SIGNATURE_COLUMN].tolist()))
+
+
+def _to_rows(content, parameter):
+    if not isinstance(content, list):
+        content = [content]
+    rows = []
+    for element in content:
+        row = dict(element)
+        row.update(parameter)
+        rows.append(row)
+    return rows
+
+
+def _kind(value):
+    if isinstance(value, bool):
+        return '?'
+    if isinstance(value, numbers.Integral):
+        return 'i'
+    if isinstance(value, numbers.Real):
+        return 'f'
+    if isinstance(value, _string_types):
+        return 'U'
+    return None
+
+
+_KIND_ORDER = '?ifU'
+_KIND_DTYPE = {'?': '?', 'i': '<i8', 'f': '<f8'}
+
+
+def _merge_dtype(dtype, rows):
+    kinds = {}
+    widths = {}
+    if dtype is not None:
+        for name in dtype.names:
+            kinds[name] = dtype[name].kind
+            if kinds[name] == 'b':
+                kinds[name] = '?'
+            elif kinds[name] == 'U':
+                widths[name] = dtype[name].itemsize // 4
+
+    def widen(name, kind):
+        old = kinds.get(name)
+        if old is None or _KIND_ORDER.index(kind) > _KIND_ORDER.index(old):
+            kinds[name] = kind
+
+    for row in rows:
+        for name, value in row.items():
+            kind = _kind(value)
+            if kind is None:
+                continue
+            widen(name, kind)
+            if kind == 'U':
+                widths[name] = max(widths.get(name, _STRING_WIDTH), len(value))
+    for name in list(kinds):
+        new_column = dtype is not None and name not in dtype.names
+        if kinds[name] in '?i' and \
+                (new_column or any(name not in row for row in rows)):
+            # Missing values are represented by NaN.
+            widen(name, 'f')
+
+    fields = []
+    for name in sorted(kinds):
+        if kinds[name] == 'U':
+            fields.append((name, '<U%d' % widths.get(name, _STRING_WIDTH)))
+        else:
+            fields.append((name, _KIND_DTYPE[kinds[name]]))
+    new_dtype = np.dtype(fields)
+    if dtype is not None and new_dtype == dtype:
+        return dtype
+    return new_dtype
+
+
+def _missing(dtype):
+    if dtype.kind == 'U':
+        return ''
+    return np.nan
+
+
+def _to_array(rows, dtype):
+    array = np.zeros(len(rows), dtype)
+    for name in dtype.names:
+        missing = _missing(dtype[name])
+        column = []
+        for row in rows:
+            value = row.get(name, missing)
+            if _kind(value) is None:
+                value = missing
+            elif dtype[name].kind == 'U':
+                value = value if isinstance(value, _string_types) else str(value)
+            column.append(value)
+        array[name] = column
+    return array
+
+
+def _convert(data, dtype):
+    array = np.zeros(len(data), dtype)
+    for name in dtype.names:
+        if name in data.dtype.names:
+            array[name] = data[name].astype(dtype[name])
+        else:
+            array[name] = _missing(dtype[name])
+    return array
+
+
+def _present(column):
+    if column.dtype.kind == 'f':
+        return ~np.isnan(column)
+    if column.dtype.kind == 'U':
+        return column != ''
+    return np.ones(len(column), dtype=bool)
+
+
+def _latest(ids, batches):
+    if len(ids) == 0:
+        return np.zeros(0, dtype=bool)
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    latest = np.full(len(unique_ids), -1, dtype=np.int64)
+    np.maximum.at(latest, inverse, batches)
+    return batches == latest[inverse]
+
+
+def _group(columns):
+    code = np.zeros(len(columns[0]), dtype=np.int64)
+    for column in columns:
+        unique, inverse = np.unique(column, return_inverse=True)
+        code = code * len(unique) + inverse
+        code = np.unique(code, return_inverse=True)[1]
+    first = np.unique(code, return_index=True)[1]
+    return first, code
+
+
+def _header_bytes(dtype, count, size=None):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        np.lib.format.dtype_to_descr(dtype), count)
+    if size is None:
+        # Leave room for the shape to grow, and align the data to 64 bytes.
+        size = (len(_MAGIC) + 2 + len(header) + 32 + 63) // 64 * 64
+    header = header.ljust(size - len(_MAGIC) - 2 - 1) + '\n'
+    return _MAGIC + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+def _read_header(path):
+    # Returns (dtype, count, offset of data) or None.
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        np.lib.format.read_magic(f)
+        shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        return dtype, shape[0], f.tell()
+
+
+def _write(path, array):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_header_bytes(array.dtype, len(array)))
+        f.write(array.tobytes())
+    os.rename(tmp_path, path)
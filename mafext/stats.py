@@ -0,0 +1,347 @@
+"""
+Streaming statistics of experiment results.
+
+:py:func:`summarize` is an aggregator that computes count, mean, variance,
+min/max and approximate quantiles of a value through all inputs of an
+aggregation task. Unlike :py:func:`maflib.util.aggregator`, it reads inputs one
+by one without collecting them into one list, and keeps a mergeable summary of
+the inputs next to the output node with the signatures of the inputs. When the
+task runs again and inputs are only added, only the new inputs are read and
+merged into the summary; if any input is removed or modified, all inputs are
+read again.
+
+"""
+
+import json
+import math
+
+import waflib.Utils
+
+import maflib.core
+import mafext.util
+
+STATISTICS = ('count', 'mean', 'variance', 'stddev', 'min', 'max')
+"""Keys of statistics written by :py:func:`summarize` besides quantiles."""
+
+
+def summarize(key, quantiles=(0.5, 0.95, 0.99), relative_accuracy=0.01):
+    """Creates an aggregator that summarizes values of given key.
+
+    It can be used as a rule of tasks with ``aggregate_by`` or ``for_each``.
+    Each input is a JSON object or an array of JSON objects as in
+    :py:func:`maflib.util.aggregator`; objects without ``key`` are ignored. The
+    output is a JSON object like below, which also contains the parameter of
+    the output node. Names of the statistics cannot be used as parameter keys.
+
+    .. code-block:: javascript
+
+        {"count": 30, "mean": 1.002, "variance": 1.2e-06, "stddev": 0.0011,
+         "min": 1.001, "max": 1.006, "p50": 1.002, "p95": 1.004, "p99": 1.006}
+
+    Quantiles are approximated so that the relative error is at most
+    ``relative_accuracy``.
+
+    :param key: Key of values to be summarized.
+    :type key: ``str``
+    :param quantiles: Quantiles written to the output. ``q`` is written as the
+        value of ``'p%g' % (q * 100)``.
+    :type quantiles: ``tuple`` of ``float``
+    :param relative_accuracy: Relative accuracy of quantiles.
+    :type relative_accuracy: ``float``
+    :return: An aggregator.
+    :rtype: :py:class:`maflib.core.Rule`
+
+    """
+    statistics = STATISTICS + tuple('p%g' % (q * 100) for q in quantiles)
+
+    def body(task):
+        conflicts = sorted(set(task.parameter) & set(statistics))
+        if conflicts:
+            raise maflib.core.InvalidMafArgumentException(
+                'parameter keys %s conflict with statistics of summarize' %
+                ', '.join(conflicts))
+
+        output = task.outputs[0]
+        state = _SummaryState(
+            output.abspath() + '.summary', key, relative_accuracy)
+
+        nodes = [node for node, _ in
+                 zip(task.inputs, task.env.source_parameter)]
+        summary = state.update(nodes)
+        state.save()
+
+        result = summary.to_result(quantiles)
+        for k in task.parameter:
+            result[k] = _to_jsonable(task.parameter[k])
+        output.write(json.dumps(result))
+
+    return maflib.core.Rule(
+        fun=body, dependson=[summarize, key, quantiles, relative_accuracy])
+
+
+class Summary(object):
+    """Mergeable summary of a stream of values.
+
+    Mean and variance are updated by Welford's algorithm and merged by Chan's
+    formula, so a summary of concatenated streams is computed from summaries
+    of each stream without reading values again.
+
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.count = 0
+        self.mean = 0.0
+        self.min = None
+        self.max = None
+        self._m2 = 0.0
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def add(self, value):
+        """Adds a value to the summary.
+
+        :param value: A number.
+
+        """
+        value = float(value)
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.sketch.add(value)
+
+    def merge(self, other):
+        """Merges another summary into this summary.
+
+        :param other: Summary to be merged. It is not modified.
+        :type other: :py:class:`Summary`
+
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self.sketch.merge(other.sketch)
+
+    @property
+    def variance(self):
+        """Unbiased variance of values, or 0 if less than two values are
+        added."""
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    def quantile(self, q):
+        """Gets an approximate ``q``-quantile of values.
+
+        :param q: A number in [0, 1].
+        :type q: ``float``
+        :rtype: ``float`` or None if the summary is empty.
+
+        """
+        value = self.sketch.quantile(q)
+        if value is None:
+            return None
+        return min(max(value, self.min), self.max)
+
+    def to_result(self, quantiles):
+        """Gets a dictionary of statistics written by :py:func:`summarize`.
+
+        :param quantiles: Quantiles to be included.
+        :type quantiles: ``tuple`` of ``float``
+        :rtype: ``dict``
+
+        """
+        if self.count == 0:
+            return {'count': 0}
+        result = {
+            'count': self.count,
+            'mean': self.mean,
+            'variance': self.variance,
+            'stddev': math.sqrt(self.variance),
+            'min': self.min,
+            'max': self.max,
+        }
+        for q in quantiles:
+            result['p%g' % (q * 100)] = self.quantile(q)
+        return result
+
+    def to_dict(self):
+        """Serializes the summary to a JSON-serializable dictionary."""
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self._m2,
+            'min': self.min,
+            'max': self.max,
+            'sketch': self.sketch.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """Deserializes a summary serialized by :py:meth:`to_dict`."""
+        summary = cls()
+        summary.count = d['count']
+        summary.mean = d['mean']
+        summary._m2 = d['m2']
+        summary.min = d['min']
+        summary.max = d['max']
+        summary.sketch = QuantileSketch.from_dict(d['sketch'])
+        return summary
+
+
+class QuantileSketch(object):
+    """Mergeable sketch of a distribution for approximate quantiles.
+
+    Values are counted in buckets whose bounds grow geometrically, so that any
+    value in a bucket is within ``relative_accuracy`` of the representative
+    value of the bucket. Merging two sketches is adding their bucket counts.
+
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self._positive = {}
+        self._negative = {}
+        self._zero = 0
+
+    def add(self, value):
+        if value > 0:
+            index = self._index(value)
+            self._positive[index] = self._positive.get(index, 0) + 1
+        elif value < 0:
+            index = self._index(-value)
+            self._negative[index] = self._negative.get(index, 0) + 1
+        else:
+            self._zero += 1
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('cannot merge sketches of different accuracies')
+        for index, count in other._positive.items():
+            self._positive[index] = self._positive.get(index, 0) + count
+        for index, count in other._negative.items():
+            self._negative[index] = self._negative.get(index, 0) + count
+        self._zero += other._zero
+
+    def quantile(self, q):
+        count = self._zero + sum(self._positive.values()) + \
+            sum(self._negative.values())
+        if count == 0:
+            return None
+        rank = q * (count - 1)
+
+        seen = 0
+        for index in sorted(self._negative, reverse=True):
+            seen += self._negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self._zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self._positive):
+            seen += self._positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self._value(max(self._positive))
+
+    def to_dict(self):
+        # JSON object keys must be strings.
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'positive': dict((str(i), c) for i, c in self._positive.items()),
+            'negative': dict((str(i), c) for i, c in self._negative.items()),
+            'zero': self._zero,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['relative_accuracy'])
+        sketch._positive = dict((int(i), c) for i, c in d['positive'].items())
+        sketch._negative = dict((int(i), c) for i, c in d['negative'].items())
+        sketch._zero = d['zero']
+        return sketch
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+
+class _SummaryState(object):
+    # Summary of the inputs folded so far, persisted with the signatures of the
+    # folded inputs. New inputs are folded into the summary; if any folded
+    # input is removed or modified, the summary is rebuilt from all inputs.
+    def __init__(self, path, key, relative_accuracy):
+        self.path = path
+        self.key = key
+        self.relative_accuracy = relative_accuracy
+        self.summary = None
+        self._inputs = {}
+
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if state['key'] == key and \
+                    state['relative_accuracy'] == relative_accuracy:
+                self.summary = Summary.from_dict(state['summary'])
+                self._inputs = state['inputs']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def update(self, nodes):
+        """Makes the summary of given input nodes, reading only the inputs not
+        folded yet."""
+        signatures = [
+            (node.abspath(),
+             waflib.Utils.to_hex(mafext.util.node_signature(node)))
+            for node in nodes]
+        current = dict(signatures)
+        if self.summary is None or any(
+                current.get(path) != signature
+                for path, signature in self._inputs.items()):
+            self.summary = Summary(self.relative_accuracy)
+            self._inputs = {}
+
+        for path, signature in signatures:
+            if path not in self._inputs:
+                self._fold(path)
+                self._inputs[path] = signature
+        return self.summary
+
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump({
+                'key': self.key,
+                'relative_accuracy': self.relative_accuracy,
+                'summary': self.summary.to_dict(),
+                'inputs': self._inputs,
+            }, f)
+
+    def _fold(self, path):
+        with open(path) as f:
+            content = json.load(f)
+        if not isinstance(content, list):
+            content = [content]
+        for element in content:
+            if self.key in element:
+                self.summary.add(element[self.key])
+
+
+def _to_jsonable(v):
+    try:
+        json.dumps(v)
+        return v
+    except (TypeError, ValueError):
+        return str(v)
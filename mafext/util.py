@@ -0,0 +1,30 @@
+"""
+Utilities shared by modules of mafext.
+
+"""
+
+import waflib.Utils
+
+
+def node_signature(node, hash_file=True):
+    """Gets the signature of a node as waf sees it.
+
+    The signature of a build node is the one of the task producing it, and
+    that of a source node is the hash of the file. Nodes not made by waf, e.g.
+    nodes of :py:class:`maflib.test.TestTask`, get the hash of the file if
+    ``hash_file`` is True.
+
+    :param node: Node.
+    :type node: :py:class:`waflib.Node.Node`
+    :param hash_file: Whether to hash the file of a node not made by waf.
+    :type hash_file: ``bool``
+    :return: The signature, or None if the node is not made by waf and
+        ``hash_file`` is False.
+    :rtype: ``bytes``
+
+    """
+    if hasattr(node, 'get_bld_sig'):
+        return node.get_bld_sig()
+    if hash_file:
+        return waflib.Utils.h_file(node.abspath())
+    return None
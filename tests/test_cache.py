@@ -0,0 +1,133 @@
+import functools
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+import maflib.core
+from mafext.cache import ResultCache, source_digest
+
+
+def _decorate(callback_body):
+    @functools.wraps(callback_body)
+    def callback(task):
+        return callback_body(task)
+    return callback
+
+
+def _one(task):
+    return 1
+
+
+def _two(task):
+    return 2
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResultCache(os.path.join(self.directory, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_store_and_retrieve(self):
+        paths = [self.write('a', 'A'), self.write('b', 'B')]
+        self.assertTrue(self.cache.store('0123', paths))
+        self.assertFalse(self.cache.store('0123', paths))
+
+        outputs = [os.path.join(self.directory, n) for n in ['c', 'd']]
+        self.assertTrue(self.cache.retrieve('0123', outputs))
+        self.assertEqual(['A', 'B'], [self.read(p) for p in outputs])
+
+    def test_miss(self):
+        output = os.path.join(self.directory, 'c')
+        self.assertFalse(self.cache.retrieve('0123', [output]))
+        self.assertFalse(os.path.exists(output))
+
+    def test_number_of_outputs_must_match(self):
+        self.cache.store('0123', [self.write('a', 'A'), self.write('b', 'B')])
+        self.assertFalse(self.cache.retrieve('0123', [self.write('c', '')]))
+        self.assertFalse(self.cache.retrieve(
+            '0123', [self.write(n, '') for n in 'cde']))
+
+    def test_evict_least_recently_used(self):
+        cache = ResultCache(self.cache.path, max_size=2)
+        for i in range(4):
+            cache.store('k%d' % i, [self.write('a', 'A')])
+            os.utime(cache.entry_path('k%d' % i), (i, i))
+        # Using an entry makes it the most recent.
+        cache.retrieve('k0', [os.path.join(self.directory, 'c')])
+
+        self.assertEqual(2, cache.evict())
+        keys = sorted(os.path.basename(path) for path, _, _ in cache.entries())
+        self.assertEqual(['k0', 'k3'], keys)
+
+    def test_evict_removes_old_temporary_files(self):
+        old = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache.path)
+        new = tempfile.mkdtemp(prefix='.tmp-', dir=self.cache.path)
+        t = time.time() - 2 * 24 * 60 * 60
+        os.utime(old, (t, t))
+        self.cache.evict()
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def test_evict_if_due(self):
+        cache = ResultCache(self.cache.path, max_size=1)
+        # Nothing is stored by this object.
+        ResultCache(self.cache.path).store('k0', [self.write('a', 'A')])
+        self.assertEqual(0, cache.evict_if_due())
+
+        cache.store('k1', [self.write('a', 'A')])
+        os.utime(cache.entry_path('k0'), (0, 0))
+        self.assertEqual(1, cache.evict_if_due())
+
+        # Evicted within the interval.
+        cache.store('k2', [self.write('a', 'A')])
+        self.assertEqual(0, cache.evict_if_due())
+        self.assertEqual(1, cache.evict_if_due(interval=0))
+
+
+class TestSourceDigest(unittest.TestCase):
+    def test_wrapped_functions(self):
+        self.assertEqual(source_digest(_decorate(_one)),
+                         source_digest(_decorate(_one)))
+        self.assertNotEqual(source_digest(_decorate(_one)),
+                            source_digest(_decorate(_two)))
+
+    def test_rule(self):
+        def rule(fun, value):
+            r = maflib.core.Rule(fun, [value])
+            return lambda task: r.fun(task)
+        self.assertEqual(source_digest(rule(_one, 1)),
+                         source_digest(rule(_one, 1)))
+        self.assertNotEqual(source_digest(rule(_one, 1)),
+                            source_digest(rule(_two, 1)))
+        self.assertNotEqual(source_digest(rule(_one, 1)),
+                            source_digest(rule(_one, 2)))
+
+    def test_partial(self):
+        self.assertNotEqual(source_digest(functools.partial(_one, 1)),
+                            source_digest(functools.partial(_two, 1)))
+
+    def test_source_not_available(self):
+        namespace = {}
+        exec('def f(task):\n    return 0\n', namespace)
+        self.assertIsNone(source_digest(namespace['f']))
+        self.assertIsNone(source_digest(_decorate(namespace['f'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
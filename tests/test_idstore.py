@@ -0,0 +1,101 @@
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import maflib.core
+from mafext.idstore import ParameterIdStore
+
+
+def _parameter(**kw):
+    return maflib.core.Parameter(kw)
+
+
+class TestParameterIdStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'ids.db')
+        self.legacy_path = os.path.join(self.directory, 'legacy')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, legacy_path=None):
+        store = ParameterIdStore(self.path, legacy_path)
+        self.addCleanup(store.close)
+        return store
+
+    def test_ids_are_persistent(self):
+        store = self.open()
+        self.assertEqual('0', store.get_id(_parameter(a=1)))
+        self.assertEqual('1', store.get_id(_parameter(a=2)))
+        self.assertEqual('0', store.get_id(_parameter(a=1)))
+        store.save()
+
+        store = self.open()
+        self.assertEqual('1', store.get_id(_parameter(a=2)))
+        self.assertEqual('2', store.get_id(_parameter(a=3)))
+
+    def test_unsaved_ids_are_discarded(self):
+        store = self.open()
+        store.get_id(_parameter(a=1))
+        store.close()
+        self.assertEqual('0', self.open().get_id(_parameter(a=2)))
+
+    def test_key_does_not_depend_on_order(self):
+        store = self.open()
+        p = maflib.core.Parameter([('a', 1), ('b', 'x')])
+        q = maflib.core.Parameter([('b', 'x'), ('a', 1)])
+        self.assertEqual(store.get_id(p), store.get_id(q))
+
+    def test_import_legacy_table(self):
+        generator = maflib.core.ParameterIdGenerator(
+            self.legacy_path, self.legacy_path + '.txt')
+        parameters = [_parameter(a=i, b=str(i)) for i in range(3)]
+        ids = [generator.get_id(p) for p in parameters]
+        generator.save()
+
+        store = self.open(self.legacy_path)
+        self.assertEqual(ids, [store.get_id(p) for p in parameters])
+        self.assertEqual('3', store.get_id(_parameter(a=3)))
+
+    def test_import_legacy_table_with_holes(self):
+        with open(self.legacy_path, 'wb') as f:
+            pickle.dump([{'a': 0}, None, {'a': 2}], f)
+
+        store = self.open(self.legacy_path)
+        self.assertEqual('2', store.get_id(_parameter(a=2)))
+        self.assertEqual('3', store.get_id(_parameter(a=1)))
+
+    def test_legacy_table_is_not_imported_twice(self):
+        with open(self.legacy_path, 'wb') as f:
+            pickle.dump([{'a': 0}], f)
+        store = self.open()
+        store.get_id(_parameter(a=5))
+        store.save()
+        store.close()
+
+        store = self.open(self.legacy_path)
+        self.assertEqual('1', store.get_id(_parameter(a=0)))
+
+    def test_dump(self):
+        store = self.open()
+        store.get_id(_parameter(a=1))
+        store.get_id(_parameter(a=2))
+        store.save()
+
+        text_path = os.path.join(self.directory, 'ids.tsv')
+        store.dump(text_path)
+        with open(text_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(['0', '1'], [line.split('\t')[0] for line in lines])
+        self.assertEqual(str(_parameter(a=2)), lines[1].split('\t')[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
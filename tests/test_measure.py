@@ -0,0 +1,195 @@
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import maflib.core
+import mafext.measure
+from mafext.measure import _confidence_interval, _RepeatLog, _substitute
+
+
+class _Node(object):
+    def __init__(self, path):
+        self.path = path
+
+    def abspath(self):
+        return self.path
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read()
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+
+class _Task(object):
+    def __init__(self, inputs, outputs, parameter):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.parameter = parameter
+
+
+class MeasureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def node(self, name):
+        return _Node(os.path.join(self.directory, name))
+
+    def task(self, inputs=(), parameter=None):
+        return _Task(list(inputs), [self.node('out')], parameter or {})
+
+
+class TestSubstitute(MeasureTestCase):
+    def test_variables(self):
+        task = _Task([self.node('a'), self.node('b')], [self.node('c')],
+                     {'T': 1, 'name': 'x'})
+        self.assertEqual(
+            'prog %s/a %s/b > %s/c --t 1 --name=x' % ((self.directory,) * 3),
+            _substitute('prog ${SRC} > ${TGT} --t ${T} --name=${name}', task))
+
+    def test_shell_dollars_are_left(self):
+        task = self.task(parameter={'T': 1})
+        for cmd in ['echo $HOME', 'echo ${HOME}', "awk '{print $1}'",
+                    'echo $(date)', 'echo $$ $', 'echo $T']:
+            self.assertEqual(cmd, _substitute(cmd, task))
+
+    def test_shell_dollars_in_measured_command(self):
+        task = self.task()
+        rule = mafext.measure.measured(
+            'echo $HOME ${HOME} $(true) | awk \'{print $1}\' > /dev/null')
+        self.assertEqual(0, rule.fun(task))
+        self.assertEqual(0, json.loads(task.outputs[0].read())['returncode'])
+
+
+class TestAdaptive(MeasureTestCase):
+    def measure(self, task, cmd='true', **kw):
+        kw.setdefault('max_absolute_ci', 1000)
+        rule = mafext.measure.adaptive(cmd, **kw)
+        returncode = rule.fun(task)
+        return returncode, json.loads(task.outputs[0].read())
+
+    def test_min_repeats(self):
+        returncode, records = self.measure(self.task(), min_repeats=3)
+        self.assertEqual(0, returncode)
+        self.assertEqual([0, 1, 2], [r['repeat'] for r in records])
+
+    def test_max_repeats(self):
+        _, records = self.measure(
+            self.task(), max_absolute_ci=None, max_relative_ci=0,
+            min_repeats=2, max_repeats=4)
+        self.assertEqual(4, len(records))
+
+    def test_logged_repeats_are_reused(self):
+        task = self.task()
+        _, first = self.measure(task, min_repeats=3, max_repeats=3)
+        _, second = self.measure(task, min_repeats=5, max_repeats=5)
+        self.assertEqual(first, second[:3])
+        self.assertEqual([0, 1, 2, 3, 4], [r['repeat'] for r in second])
+
+        # Decreasing max_repeats does not exceed the budget.
+        _, third = self.measure(task, min_repeats=2, max_repeats=2)
+        self.assertEqual(second[:2], third)
+
+    def test_log_is_discarded_when_inputs_change(self):
+        source = self.node('in')
+        source.write('a')
+        task = self.task([source])
+        _, first = self.measure(task, min_repeats=2)
+        _, second = self.measure(task, min_repeats=2)
+        self.assertEqual(first, second)
+
+        source.write('b')
+        _, third = self.measure(task, min_repeats=2)
+        self.assertNotEqual(first, third)
+
+    def test_failure(self):
+        task = self.task()
+        returncode, records = self.measure(task, 'exit 3', min_repeats=3)
+        self.assertEqual(3, returncode)
+        self.assertEqual([3], [r['returncode'] for r in records])
+        # The failed repeat is not logged.
+        log_path = task.outputs[0].abspath() + '.repeats'
+        self.assertFalse(os.path.exists(log_path))
+
+        returncode, records = self.measure(
+            task, 'exit 3', min_repeats=3, check=False)
+        self.assertEqual(0, returncode)
+        self.assertEqual(3, len(records))
+
+    def test_invalid_repeats(self):
+        for min_repeats, max_repeats in [(1, 3), (4, 3)]:
+            self.assertRaises(
+                maflib.core.InvalidMafArgumentException,
+                mafext.measure.adaptive, 'true', min_repeats=min_repeats,
+                max_repeats=max_repeats)
+
+
+class TestRepeatLog(MeasureTestCase):
+    def setUp(self):
+        super(TestRepeatLog, self).setUp()
+        self.path = self.node('log').abspath()
+        self.log = _RepeatLog(self.path, {'command': 'true'})
+        self.log.append({'repeat': 0})
+        self.log.append({'repeat': 1})
+
+    def lines(self):
+        with open(self.path) as f:
+            return f.read().split('\n')
+
+    def test_load(self):
+        self.assertEqual([{'repeat': 0}, {'repeat': 1}], self.log.load())
+
+    def test_missing_log(self):
+        self.assertEqual([], _RepeatLog(self.node('x').abspath(), {}).load())
+
+    def test_broken_last_line(self):
+        with open(self.path, 'a') as f:
+            f.write('{"repe')
+        self.assertEqual([{'repeat': 0}, {'repeat': 1}], self.log.load())
+        # The broken line is removed, so records can be appended again.
+        self.log.append({'repeat': 2})
+        self.assertEqual(3, len(self.log.load()))
+        self.assertEqual(5, len(self.lines()))
+
+    def test_log_of_another_measurement(self):
+        log = _RepeatLog(self.path, {'command': 'false'})
+        self.assertEqual([], log.load())
+        self.assertFalse(os.path.exists(self.path))
+        log.append({'repeat': 0})
+        self.assertEqual([{'repeat': 0}], log.load())
+        self.assertEqual([], self.log.load())
+
+    def test_not_a_log(self):
+        with open(self.path, 'w') as f:
+            f.write('not json\n')
+        self.assertEqual([], self.log.load())
+
+
+class TestConfidenceInterval(unittest.TestCase):
+    def test_confidence_interval(self):
+        mean, half_width = _confidence_interval([1, 2, 3])
+        self.assertAlmostEqual(2, mean)
+        self.assertAlmostEqual(4.303 / 3 ** 0.5, half_width)
+
+    def test_large_degrees_of_freedom(self):
+        # The nearest smaller entry (df = 40) is used.
+        values = [0, 2] * 25
+        mean, half_width = _confidence_interval(values)
+        self.assertAlmostEqual(1, mean)
+        variance = 50.0 / 49
+        self.assertAlmostEqual(2.021 * (variance / 50) ** 0.5, half_width)
+
+    def test_constant_values(self):
+        self.assertEqual((5.0, 0.0), _confidence_interval([5, 5, 5]))
+
+
+if __name__ == '__main__':
+    unittest.main()
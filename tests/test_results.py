@@ -0,0 +1,149 @@
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import mafext.results
+from mafext.results import (BATCH_COLUMN, ID_COLUMN, SIGNATURE_COLUMN,
+                            ColumnPlotData, ColumnStore)
+
+
+class TestColumnStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ColumnStore(os.path.join(self.directory, 'r.columns.npy'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        self.store.append(0, [{'x': 1, 'y': 0.5, 'name': 'a', 'ok': True}])
+        self.store.append(1, [{'x': 2, 'y': 1.5, 'name': 'b', 'ok': False},
+                              {'x': 3, 'y': 2.5, 'name': 'c', 'ok': True}])
+
+        columns = self.store.columns()
+        self.assertEqual([0, 1, 1], columns[ID_COLUMN].tolist())
+        self.assertEqual([1, 2, 3], columns['x'].tolist())
+        self.assertEqual([0.5, 1.5, 2.5], columns['y'].tolist())
+        self.assertEqual(['a', 'b', 'c'], columns['name'].tolist())
+        self.assertEqual([True, False, True], columns['ok'].tolist())
+        self.assertEqual('i', columns['x'].dtype.kind)
+
+        # The file is a plain .npy file.
+        data = np.load(self.store.path)
+        self.assertEqual(3, len(data))
+
+    def test_columns_of_ids(self):
+        self.store.append(0, [{'x': 1}])
+        self.store.append(1, [{'x': 2}])
+        self.store.append(2, [{'x': 3}])
+        self.assertEqual([1, 3], self.store.columns([0, 2])['x'].tolist())
+
+    def test_columns_of_missing_store(self):
+        self.assertEqual({}, self.store.columns())
+
+    def test_widen(self):
+        self.store.append(0, [{'v': True}])
+        self.store.append(1, [{'v': 2}])
+        self.assertEqual('i', self.store.columns()['v'].dtype.kind)
+        self.assertEqual([1, 2], self.store.columns()['v'].tolist())
+
+        self.store.append(2, [{'v': 2.5}])
+        self.assertEqual([1.0, 2.0, 2.5], self.store.columns()['v'].tolist())
+
+        self.store.append(3, [{'v': 'x' * 100}])
+        self.assertEqual(['1.0', '2.0', '2.5', 'x' * 100],
+                         self.store.columns()['v'].tolist())
+
+    def test_new_column_is_missing_in_old_rows(self):
+        self.store.append(0, [{'x': 1}])
+        self.store.append(1, [{'x': 2, 'y': 3, 's': 'a'}])
+
+        columns = self.store.columns()
+        self.assertEqual('f', columns['y'].dtype.kind)
+        self.assertTrue(np.isnan(columns['y'][0]))
+        self.assertEqual(3.0, columns['y'][1])
+        self.assertEqual(['', 'a'], columns['s'].tolist())
+
+    def test_supersede(self):
+        self.store.append(0, [{'x': 1}, {'x': 2}])
+        self.store.append(1, [{'x': 10}])
+        self.store.append(0, [{'x': 3}])
+
+        columns = self.store.columns()
+        self.assertEqual([10, 3], columns['x'].tolist())
+        self.assertEqual([1, 0], columns[ID_COLUMN].tolist())
+        # Superseded rows remain in the file.
+        self.assertEqual(4, len(self.store.load()))
+
+    def test_compact(self):
+        self.store.append(0, [{'x': 1}, {'x': 2}])
+        self.store.append(1, [{'x': 10}])
+        self.store.append(0, [{'x': 3}])
+        before = self.store.columns()
+
+        self.store.compact()
+        self.assertEqual(2, len(self.store.load()))
+        after = self.store.columns()
+        self.assertEqual(sorted(before), sorted(after))
+        # Batch numbers are renumbered.
+        for name in set(before) - set([BATCH_COLUMN]):
+            self.assertEqual(before[name].tolist(), after[name].tolist())
+
+        # Appending to a compacted store supersedes the kept rows.
+        self.store.append(1, [{'x': 20}])
+        self.assertEqual([3, 20], self.store.columns()['x'].tolist())
+        self.assertEqual(3, len(self.store.load()))
+
+    def test_columns_compact_superseded_rows(self):
+        self.store.append(0, [{'x': 1}, {'x': 2}])
+        self.store.append(0, [{'x': 3}, {'x': 4}])
+        self.store.append(1, [{'x': 10}])
+        self.store.append(1, [{'x': 20}])
+        # 3 of 6 rows are superseded.
+        self.assertEqual([3, 4, 20], self.store.columns()['x'].tolist())
+        self.assertEqual(6, len(self.store.load()))
+
+        self.store.append(0, [{'x': 5}])
+        self.assertEqual([20, 5], self.store.columns()['x'].tolist())
+        self.assertEqual(2, len(self.store.load()))
+        self.assertEqual([20, 5], self.store.columns()['x'].tolist())
+
+    def test_signature(self):
+        stamp = mafext.results.signature_stamp(b'\xff' * 16)
+        self.assertEqual(2 ** 52 - 1, stamp)
+        self.store.append(0, [{'x': 1}])
+        self.store.append(1, [{'x': 2}], stamp)
+
+        columns = self.store.columns()
+        self.assertTrue(np.isnan(columns[SIGNATURE_COLUMN][0]))
+        # Stamps are exact in a float column.
+        self.assertEqual(stamp, int(columns[SIGNATURE_COLUMN][1]))
+
+
+class TestColumnPlotData(unittest.TestCase):
+    def setUp(self):
+        self.data = ColumnPlotData({
+            'x': np.array([2, 1, 3, 1]),
+            'y': np.array([20.0, 10.0, np.nan, 11.0]),
+            'k': np.array(['a', 'a', 'b', 'b']),
+        })
+
+    def test_get_data_2d(self):
+        self.assertEqual(([1, 1, 2], [10.0, 11.0, 20.0]),
+                         self.data.get_data_2d('x', 'y'))
+
+    def test_get_data_2d_by_key(self):
+        self.assertEqual({'a': ([1, 2], [10.0, 20.0]), 'b': ([1], [11.0])},
+                         self.data.get_data_2d('x', 'y', key='k'))
+
+    def test_missing_column(self):
+        self.assertEqual([], self.data.get_data_1d('z'))
+        self.assertEqual({}, self.data.get_data_1d('z', key='k'))
+
+
+if __name__ == '__main__':
+    unittest.main()
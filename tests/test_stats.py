@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import os.path
+import random
+import shutil
+import tempfile
+import unittest
+
+import maflib.core
+from mafext.stats import QuantileSketch, Summary, _SummaryState, summarize
+
+
+def _summary(values):
+    summary = Summary()
+    for v in values:
+        summary.add(v)
+    return summary
+
+
+class TestSummary(unittest.TestCase):
+    def setUp(self):
+        r = random.Random(1)
+        self.values = [r.lognormvariate(0, 1) for _ in range(1000)]
+        self.values += [0.0, -1.5, -0.25]
+        r.shuffle(self.values)
+
+    def test_statistics(self):
+        summary = _summary(self.values)
+        n = len(self.values)
+        mean = sum(self.values) / n
+        variance = sum((v - mean) ** 2 for v in self.values) / (n - 1)
+        self.assertEqual(n, summary.count)
+        self.assertAlmostEqual(mean, summary.mean)
+        self.assertAlmostEqual(variance, summary.variance)
+        self.assertEqual(min(self.values), summary.min)
+        self.assertEqual(max(self.values), summary.max)
+
+    def test_merge_equivalence(self):
+        whole = _summary(self.values)
+        for parts in [2, 3, 17]:
+            size = (len(self.values) + parts - 1) // parts
+            merged = Summary()
+            for i in range(0, len(self.values), size):
+                merged.merge(_summary(self.values[i:i + size]))
+            self.assertEqual(whole.count, merged.count)
+            self.assertAlmostEqual(whole.mean, merged.mean)
+            self.assertAlmostEqual(whole.variance, merged.variance)
+            self.assertEqual(whole.min, merged.min)
+            self.assertEqual(whole.max, merged.max)
+            for q in [0.0, 0.01, 0.5, 0.95, 0.99, 1.0]:
+                self.assertEqual(whole.quantile(q), merged.quantile(q))
+
+    def test_merge_empty(self):
+        summary = _summary([1.0, 2.0])
+        summary.merge(Summary())
+        self.assertEqual(2, summary.count)
+        empty = Summary()
+        empty.merge(summary)
+        self.assertEqual(1.5, empty.mean)
+        self.assertEqual(1.0, empty.min)
+
+    def test_quantile_accuracy(self):
+        summary = _summary(self.values)
+        values = sorted(self.values)
+        for q in [0.1, 0.5, 0.9, 0.99]:
+            exact = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(
+                abs(summary.quantile(q) - exact), 0.01 * abs(exact) + 1e-12)
+
+    def test_serialization(self):
+        summary = _summary(self.values)
+        restored = Summary.from_dict(
+            json.loads(json.dumps(summary.to_dict())))
+        self.assertEqual(summary.to_result((0.5, 0.99)),
+                         restored.to_result((0.5, 0.99)))
+
+    def test_sketches_of_different_accuracies(self):
+        self.assertRaises(
+            ValueError, QuantileSketch(0.01).merge, QuantileSketch(0.02))
+
+
+class _Node(object):
+    # Node with a signature given by the test.
+    def __init__(self, path, values):
+        self.path = path
+        self.write(values)
+
+    def write(self, values):
+        with open(self.path, 'w') as f:
+            json.dump([{'v': v} for v in values], f)
+        self.signature = hashlib.md5(str(values).encode()).digest()
+
+    def abspath(self):
+        return self.path
+
+    def get_bld_sig(self):
+        return self.signature
+
+
+class TestSummaryState(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'out.summary')
+        self.nodes = [_Node(os.path.join(self.directory, str(i)), [i, i + 1])
+                      for i in range(4)]
+        self.reads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def update(self, nodes):
+        state = _SummaryState(self.path, 'v', 0.01)
+        fold = state._fold
+        def counted_fold(path):
+            self.reads.append(os.path.basename(path))
+            fold(path)
+        state._fold = counted_fold
+        summary = state.update(nodes)
+        state.save()
+        return summary
+
+    def test_fold_new_inputs(self):
+        self.update(self.nodes[:2])
+        self.reads = []
+        summary = self.update(self.nodes[:3])
+        self.assertEqual(['2'], self.reads)
+        self.assertEqual(6, summary.count)
+        self.assertEqual(1.5, summary.mean)
+
+    def test_nothing_to_read(self):
+        self.update(self.nodes)
+        self.reads = []
+        self.assertEqual(8, self.update(self.nodes).count)
+        self.assertEqual([], self.reads)
+
+    def test_rebuild_on_modification(self):
+        self.update(self.nodes)
+        self.nodes[1].write([10])
+        self.reads = []
+        summary = self.update(self.nodes)
+        self.assertEqual(['0', '1', '2', '3'], sorted(self.reads))
+        self.assertEqual(7, summary.count)
+        self.assertEqual(10.0, summary.max)
+
+    def test_rebuild_on_removal(self):
+        self.update(self.nodes)
+        summary = self.update(self.nodes[1:])
+        self.assertEqual(6, summary.count)
+        self.assertEqual(1.0, summary.min)
+
+    def test_state_of_another_key(self):
+        self.update(self.nodes)
+        state = _SummaryState(self.path, 'w', 0.01)
+        self.assertEqual(0, state.update(self.nodes).count)
+
+
+class _Env(object):
+    pass
+
+
+class _Task(object):
+    def __init__(self, inputs, output, parameter):
+        self.inputs = inputs
+        self.outputs = [output]
+        self.parameter = parameter
+        self.env = _Env()
+        self.env.source_parameter = [{} for _ in inputs]
+
+
+class _Output(object):
+    def __init__(self, path):
+        self.path = path
+
+    def abspath(self):
+        return self.path
+
+    def write(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+
+class TestSummarize(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.inputs = [_Node(os.path.join(self.directory, str(i)), [i])
+                       for i in range(3)]
+        self.output = _Output(os.path.join(self.directory, 'out'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parameter_is_written(self):
+        rule = summarize('v', quantiles=(0.5,))
+        rule.fun(_Task(self.inputs, self.output, {'n': 1}))
+        with open(self.output.path) as f:
+            result = json.load(f)
+        self.assertEqual(3, result['count'])
+        self.assertEqual(1, result['n'])
+        self.assertIn('p50', result)
+
+    def test_parameter_conflicting_with_statistics(self):
+        rule = summarize('v', quantiles=(0.5,))
+        for parameter in [{'mean': 1}, {'p50': 1}]:
+            self.assertRaises(
+                maflib.core.InvalidMafArgumentException, rule.fun,
+                _Task(self.inputs, self.output, parameter))
+        # Quantiles not written can be used.
+        rule.fun(_Task(self.inputs, self.output, {'p99': 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import waflib.Utils
+
+from mafext.util import node_signature
+
+
+class _Node(object):
+    def __init__(self, path):
+        self.path = path
+
+    def abspath(self):
+        return self.path
+
+
+class _WafNode(_Node):
+    def get_bld_sig(self):
+        return b'signature'
+
+
+class TestNodeSignature(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'a')
+        with open(self.path, 'w') as f:
+            f.write('content')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_waf_node(self):
+        node = _WafNode(self.path)
+        self.assertEqual(b'signature', node_signature(node))
+        self.assertEqual(b'signature', node_signature(node, hash_file=False))
+
+    def test_other_node(self):
+        node = _Node(self.path)
+        self.assertEqual(waflib.Utils.h_file(self.path), node_signature(node))
+        self.assertIsNone(node_signature(node, hash_file=False))
+
+
+if __name__ == '__main__':
+    unittest.main()